@@ -59,9 +59,9 @@ def create_token(x):
     if type(x) == str: return ('STRING', x)
     if type(x) == bool:  return ('BOOL', x)
     if type(x) == type(None): return ('NULL', x)
-    if type(x) == dict: return ('DICT', x)
-    if type(x) == list: return ('LIST', x)
-    if type(x) == tuple: return ('TUPLE', x)
+    if isinstance(x, dict): return ('DICT', x)
+    if isinstance(x, list): return ('LIST', x)
+    if isinstance(x, tuple): return ('TUPLE', x)
 
     # 目前还不支持 None, list, dict, tple 等类型, 做特殊处理
     # # 当获取到None时， 为False
@@ -75,6 +75,9 @@ def token_calc(env, op, xtok, ytok=None):
     op = op[1]
     x = get_token_value(env, xtok)
     # print("Get %s value=%s" % (xtok, x))
+    # && 与 || 短路求值, 左侧已经决定结果时不再取右侧的值
+    if (op == '&&' and not x) or (op == '||' and x):
+        return create_token(x)
     y = get_token_value(env, ytok) if ytok else None
     # print("Get %s value=%s" % (ytok, y))
 
@@ -237,3 +240,241 @@ def calc(env, tokens):
     result = get_token_value(env, stack.operands_stack_top())
     # print result
     return result
+
+
+plain_types = frozenset([int, float, str, bool, type(None)])
+
+# 结果总是 bool 的运算, 不需要再经过 token_value
+bool_operators = frozenset(['!', '~='])
+
+
+def token_value(x):
+    """ 与 create_token(x)[1] 相同: 运算的中间结果中 unicode 转为 str, 不支持的类型抛出异常 """
+    t = type(x)
+    if t in plain_types:
+        return x
+    if t == unicode:
+        return str(x)
+    if isinstance(x, (dict, list, tuple)):
+        return x
+    raise Exception('Unknow token type %s %s' % (type(x), x))
+
+
+class Operand:
+    """
+    编译后的表达式节点, fn(env) 返回节点的值
+    is_leaf: 常量、变量或函数调用。calc 中叶子节点在其运算符被计算时才求值, 编译后的求值顺序与之保持一致
+    is_const: 值在构建规则时已经确定, 为 value
+    path: 变量节点的 key 元组
+    以下两项用于规则集的分派索引(见 ruler.RuleIndex):
+    pure: 求值不会抛出异常也没有副作用
+    requires: 节点的值为真时必然成立的 (变量 key 元组, 常量) 相等条件
+    """
+
+    def __init__(self, fn, is_leaf, is_const=False, value=None, path=None):
+        self.fn = fn
+        self.is_leaf = is_leaf
+        self.is_const = is_const
+        self.value = value
+        self.path = path
+        self.pure = is_const
+        self.requires = ()
+
+
+def constant(value, is_leaf=False):
+    return Operand(lambda env: value, is_leaf, True, value)
+
+
+def compile_var(name):
+    """ 变量名在这里预先分割为 key 元组, 与 env.get_var(name) 相同 """
+    path = var_path(name)
+    if len(path) == 1:
+        return lambda env: env.foreach_get_var(name)
+    return lambda env: env.get_path(path)
+
+
+def var_path(name):
+    return tuple(name.split('.'))
+
+
+def compile_leaf(tok):
+    """ 与 get_token_value 相同的语义 """
+    if tok[0] == 'ID':
+        return compile_var(tok[1])
+    elif tok[0] == 'CALL':
+        name = tok[1][0]
+        get_func = compile_var(name)
+        args = [compile_leaf(arg) for arg in tok[1][1]]
+
+        def call(env):
+            func = get_func(env)
+            values = [arg(env) for arg in args]
+            if func == None:
+                raise Exception("call '%s' does not exist" % name)
+            return func(*values)
+        return call
+    value = tok[1]
+    return lambda env: value
+
+
+def compile_operation(op, x, y=None):
+    """
+    编译一次 token_calc, 操作数都是常量时在这里直接求值(求值出错的不折叠, 错误仍在匹配时抛出)
+    """
+    node = compile_operation_node(op, x, y)
+    if x.is_const and (y is None or y.is_const):
+        try:
+            return constant(node.fn(None))
+        except Exception:
+            pass
+    if node is not x and node is not y:
+        analyze_operation(op, x, y, node)
+    return node
+
+
+def analyze_operation(op, x, y, node):
+    """ 记录运算节点的 pure 与 requires """
+    operands = [x] if y is None else [x, y]
+    if op in ('==', '!=', '!'):
+        node.pure = all(o.pure or o.path is not None for o in operands)
+    elif op in ('&&', '||'):
+        node.pure = x.pure and y.pure
+
+    if op == '==':
+        for var, const in ((x, y), (y, x)):
+            if var.path is not None and const.is_const and type(const.value) in plain_types:
+                node.requires = ((var.path, const.value),)
+                break
+    elif op == '&&':
+        # 左侧先求值, 左侧可能抛出异常或有副作用时, 右侧的条件不成立并不能跳过整个条件
+        node.requires = x.requires + (y.requires if x.pure else ())
+
+
+def compile_logical(op, x, y):
+    """
+    && 与 || 短路求值, 结果为其中一个操作数的值。左侧为常量时直接化简。
+    非叶子的操作数已经是 token_value 转换过的值, 两侧都不是叶子时不需要再转换
+    """
+    if x.is_const:
+        if (op == '&&') == bool(x.value):
+            x = y
+        if not x.is_leaf:
+            return x
+        xf = x.fn
+        return Operand(lambda env: token_value(xf(env)), False, x.is_const, token_value(x.value))
+
+    xf, yf = x.fn, y.fn
+    if op == '&&':
+        operation = lambda env: xf(env) and yf(env)
+    else:
+        operation = lambda env: xf(env) or yf(env)
+    if x.is_leaf or y.is_leaf:
+        return Operand(lambda env: token_value(operation(env)), False)
+    return Operand(operation, False)
+
+
+def compile_operation_node(op, x, y=None):
+    """
+    calc 中非叶子的操作数在更早的运算中已经求值, 叶子操作数在此时按 x, y 的顺序求值,
+    所以 x 为叶子而 y 不是时, 先求 y 的值
+    """
+    fn = calc_tbl[op]
+    xf = x.fn
+    if y is None:
+        if op in bool_operators:
+            return Operand(lambda env: fn(xf(env)), False)
+        return Operand(lambda env: token_value(fn(xf(env))), False)
+
+    if op in ('&&', '||'):
+        return compile_logical(op, x, y)
+
+    yf = y.fn
+    if x.is_leaf and not y.is_leaf:
+        def operation(env):
+            yv = yf(env)
+            return fn(xf(env), yv)
+    else:
+        def operation(env):
+            return fn(xf(env), yf(env))
+
+    if op in bool_operators:
+        return Operand(operation, False)
+    return Operand(lambda env: token_value(operation(env)), False)
+
+
+def compile_tokens(tokens):
+    """
+    把 tokens 编译为表达式树, 返回根节点 Operand, Operand.fn(env) 的返回值与 calc(env, tokens) 相同
+    在构建规则时按 calc 的方式执行一遍运算符优先级的处理, 但压入操作数栈的是编译后的节点而不是计算结果,
+    求值时不再需要 CalcStack 与 Operator.level。
+    calc 在求值时才会发现的表达式错误(括号不匹配、不支持的运算符、多余的操作数等)在这里直接抛出异常。
+    """
+    stack = CalcStack()
+
+    def compile_stack_top():
+        optr = stack.pop_operator()
+        if optr[0] in ['NOT_OPERATOR']:  # 单目运算符
+            oprd2, oprd1 = None, stack.pop_operand()
+        else:  # 双目运算符
+            oprd2, oprd1 = stack.pop_operand(), stack.pop_operand()
+        stack.push_operand(compile_operation(optr[1], oprd1, oprd2))
+
+    def flush_out_stack():
+        while stack.operators_stack_top():
+            compile_stack_top()
+        # 多余的操作数在 calc 中同样会被求值, 只是结果被丢弃, 这类表达式不编译
+        if len(stack.operands) != 1:
+            raise Exception('Stack is not balance')
+
+    tok_iter = iter(tokens)
+
+    tok = tok_iter.next()
+    while True:
+        try:
+            if tok[0] in ['INTEGER', 'FLOAT', 'STRING', 'BOOL', 'NULL']:
+                stack.push_operand(constant(tok[1], is_leaf=True))
+                tok = tok_iter.next()
+            elif tok[0] == 'ID':
+                stack.push_operand(Operand(compile_leaf(tok), True, path=var_path(tok[1])))
+                tok = tok_iter.next()
+            elif tok[0] == 'CALL':
+                stack.push_operand(Operand(compile_leaf(tok), True))
+                tok = tok_iter.next()
+            elif tok[0] in ['LOGICAL_OPERATOR', 'RELATIONAL_OPERATOR', 'ARITHMEITC_OPERATOR', 'NOT_OPERATOR']:
+                stack_top = stack.operators_stack_top()
+                if stack_top:
+                    if Operator.level(stack.operators[-1][1]) < Operator.level(tok[1]):
+                        stack.push_operator(tok)
+                        tok = tok_iter.next()
+                    else:
+                        compile_stack_top()
+                else:
+                    stack.push_operator(tok)
+                    tok = tok_iter.next()
+            elif tok[0] == 'LPAREN':
+                stack.push()
+                tok = tok_iter.next()
+            elif tok[0] == 'RPAREN':
+                flush_out_stack()
+                operands, _ = stack.pop()
+                stack.operands.append(operands[0])
+                tok = tok_iter.next()
+            else:
+                raise Exception('Unknow tok %s' % str(tok))
+        except(StopIteration):
+            flush_out_stack()
+            break
+
+    if len(stack.stack) != 1:
+        raise Exception('Stack is not balance')
+    return stack.operands_stack_top()
+
+
+def compile_calc(tokens):
+    """
+    编译 tokens, 表达式有误无法编译时仍按 calc 逐次解释执行, 错误在求值时抛出, 与原来的行为一致
+    """
+    try:
+        return compile_tokens(tokens)
+    except Exception:
+        return Operand(lambda env: calc(env, tokens), False)
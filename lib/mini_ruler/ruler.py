@@ -1,19 +1,30 @@
 # -*- coding:utf-8 -*-
 
 import re
-from calc_tokens import calc
+from collections import defaultdict
+from calc_tokens import compile_calc
 from lexer import RuleLexer
 import basic_action
 
 
 class RulerEnv:
 
-    def __init__(self):
-        self.variables_stack = [{}]
+    def __init__(self, variables_stack=None):
+        self.variables_stack = variables_stack if variables_stack is not None else [{}]
         self.stack_top = self.variables_stack[-1]
 
-    def push(self):
-        self.variables_stack.append({})
+    def scope(self, scope):
+        """
+        返回一个新的 RulerEnv, 以 scope 为最上层变量, 下面各层与当前 env 共享且只读
+        每次求值使用各自的 env, 不修改当前 env 的变量栈, 可以被多个线程同时调用
+        """
+        return RulerEnv(self.variables_stack + [scope])
+
+    def push(self, scope=None):
+        """
+        scope: 直接作为新一层变量的 dict(如事件本身), 不复制; 这一层只读, 不能再对其 set_var
+        """
+        self.variables_stack.append(scope if scope is not None else {})
         self.stack_top = self.variables_stack[-1]
 
     def pop(self):
@@ -23,7 +34,7 @@ class RulerEnv:
         self.stack_top = self.variables_stack[-1]
 
     def foreach_get_var(self, var_str):
-        for level in self.variables_stack[::-1]:
+        for level in reversed(self.variables_stack):
             var = level.get(var_str, None)
             if var is not None:
                 break
@@ -55,7 +66,7 @@ class RulerEnv:
 
         result, s = var, var_str_list[0]
         for k in var_list:
-            if type(result) != dict:
+            if not isinstance(result, dict):
                 return None
             v = result.get(k, None)
             if v is None:
@@ -65,6 +76,15 @@ class RulerEnv:
 
         return result
 
+    def get_path(self, path):
+        """ 与 get_var 相同, path 为构建规则时预先分割好的 key 元组 """
+        var = self.foreach_get_var(path[0])
+        for k in path[1:]:
+            if not isinstance(var, dict):
+                return None
+            var = var.get(k, None)
+        return var
+
 
 def parse_rule(rule_str):
     rule_lines = rule_str.split("\n")
@@ -134,10 +154,69 @@ def goto_rule(rule_name):
     raise RulerGoto(rule_name)
 
 
+# 可以作为索引 key 查找的事件值类型, 其他类型(dict, list 等)的值不查索引
+index_value_types = frozenset([str, unicode, int, long, float, bool, type(None)])
+
+
+class RuleIndex:
+    """
+    规则集的分派索引
+    每条规则的条件中必然成立的 `变量 == 常量` (Operand.requires) 作为决策树的分支: 每个节点选择被最多规则
+    约束的变量, 按常量分为多个分支, 没有约束该变量的规则出现在所有分支中。
+    求值时按事件中变量的值逐层取出候选规则, 候选规则保持规则集中的顺序, 第一条匹配的规则仍然是结果。
+    被跳过的规则的条件必然为假, 且求值不会有副作用或异常, 结果与逐条遍历相同。
+    """
+
+    max_depth = 3
+    min_rules = 4
+
+    def __init__(self, rules, requires, depth=0):
+        """ rules: 规则列表; requires: 每条规则的 {变量 key 元组: 常量} """
+        self.rules = rules
+        self.path = None
+
+        if depth >= self.max_depth or len(rules) < self.min_rules:
+            return
+        counts = defaultdict(int)
+        for r in requires:
+            for path in r:
+                counts[path] += 1
+        if not counts:
+            return
+        path = max(sorted(counts), key=lambda p: counts[p])
+        if counts[path] < 2:
+            return
+
+        branches, default = {}, []
+        for i, r in enumerate(requires):
+            if path in r:
+                branches.setdefault(r[path], []).append(i)
+            else:
+                default.append(i)
+
+        def child(indexes):
+            return RuleIndex([rules[i] for i in indexes],
+                             [dict((p, v) for p, v in requires[i].items() if p != path) for i in indexes], depth + 1)
+
+        self.path = path
+        self.branches = dict((value, child(sorted(indexes + default))) for value, indexes in branches.items())
+        self.default = child(default)
+
+    def select(self, env):
+        index = self
+        while index.path is not None:
+            value = env.get_path(index.path)
+            if type(value) not in index_value_types:
+                break
+            index = index.branches.get(value, index.default)
+        return index.rules
+
+
 class Ruler:
 
     def __init__(self):
         self.rule_set_list = {}
+        self.rule_set_index = {}
         self.env = RulerEnv()
         self.lexer = RuleLexer()
         self.init_builtin_action()
@@ -174,15 +253,23 @@ class Ruler:
                 elif not hasattr(tmp, '__call__'):
                     raise RulerError("Build Rule `%s` Error" % rule)
 
-        return rule, cond_tokens, then_tokens
+        # 规则在这里编译为函数, 匹配时不再重新解释 tokens
+        cond, then = compile_calc(cond_tokens), compile_calc(then_tokens)
+        requires = {}
+        for path, value in cond.requires:
+            requires.setdefault(path, value)
+        return rule, cond_tokens, then_tokens, cond.fn, then.fn, requires
 
     def register_rule_set(self, name, rule_list):
         if name in self.rule_set_list:
             raise RulerError("can not resiger rule set '%s' reason: already exist")
-        self.rule_set_list[name] = [self.build_rule(rule) for rule in rule_list]
+        rules = [self.build_rule(rule) for rule in rule_list]
+        self.rule_set_list[name] = rules
+        self.rule_set_index[name] = RuleIndex(rules, [rule_obj[5] for rule_obj in rules])
 
     def clear_rule_set(self, name):
         del self.rule_set_list[name]
+        del self.rule_set_index[name]
 
     def register_action(self, name, action):
         if self.env.get_global_var(name) is not None:
@@ -192,21 +279,24 @@ class Ruler:
     def clear_action(self, name):
         self.env.clear_global_var(name)
 
-    def foreach_rule_set(self, name):
+    def foreach_rule_set(self, name, env=None):
         """
         遍历规则集，获得规则集的结果。
         每条规则由 Condition 和 Action 组成， Condition 若匹配中则执行 Action, 并返回Action的返回值作为Rule的返回值
+        env: 本次求值使用的 RulerEnv, 默认为 self.env
         """
-        for rule_obj in self.rule_set_list[name]:
-            rule, cond_tokens, then_tokens = rule_obj[0], rule_obj[1], rule_obj[2]
-            result = calc(self.env, cond_tokens)
+        if env is None:
+            env = self.env
+        for rule_obj in self.rule_set_index[name].select(env):
+            rule, cond, then = rule_obj[0], rule_obj[3], rule_obj[4]
+            result = cond(env)
             if result:
                 try:
-                    result = (calc(self.env, then_tokens), rule)
+                    result = (then(env), rule)
                 except RulerGoto as e:
                     rule_name = e[0]
                     try:
-                        result = self.foreach_rule_set(rule_name)
+                        result = self.foreach_rule_set(rule_name, env)
                     except RulerNoMatch:
                         continue
                 return result
@@ -217,18 +307,9 @@ class Ruler:
         if name not in self.rule_set_list:
             raise RulerError("Rule set '%s' does not exist" % name)
 
-        if type(p) != dict:
+        if not isinstance(p, dict):
             raise RulerError("Ruler.entry must input a dict, but not %s" % type(p))
 
-        self.env.push()
-        try:
-            for k, v in p.items():
-                self.env.set_var(k, v)
-            result = self.foreach_rule_set(name)
-        except RulerNoMatch:
-            # 必须捕捉RulerNoMatch，并重新抛出，否则self.env.pop可能会被略过,
-            # 导致不断压栈, 内存泄露
-            raise RulerNoMatch
-        finally:
-            self.env.pop()
-        return result
+        # 事件本身作为一层变量, 值为 None 的 key 与不存在相同, 会继续查找全局变量与 action
+        # 每次调用使用各自的 env, 不修改 self.env, 同一个 Ruler 可以被多个线程同时调用
+        return self.foreach_rule_set(name, self.env.scope(p))
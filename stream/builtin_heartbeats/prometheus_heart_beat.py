@@ -0,0 +1,245 @@
+# -*- coding:utf-8 -*-
+import os
+import time
+import threading
+import SocketServer
+import BaseHTTPServer
+from collections import deque, OrderedDict
+
+import stream.logger as logger
+from stream.stream import StreamHeartBeat
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    return ','.join('%s="%s"' % (k, escape_label(v)) for k, v in labels)
+
+
+def stream_entries(runtime_info):
+    """
+    返回 [(Stream 进程名, 标签, info)]
+    配置了 replicas 的 Stream, 各副本 <Stream>#N 以 replica 标签导出在 Stream 名下, 副本聚合后的 <Stream> 不再导出,
+    否则对同一指标求和时会重复计算
+    """
+    entries = []
+    for name, info in runtime_info.items():
+        if not isinstance(info, dict) or 'replicas' in info:
+            continue
+        if '#' in name:
+            stream, replica = name.rsplit('#', 1)
+            entries.append((name, [('stream', stream), ('replica', replica)], info))
+        else:
+            entries.append((name, [('stream', name)], info))
+    return entries
+
+
+class MetricWriter:
+    """ 按指标名归组输出, Prometheus 要求同一指标的所有样本连续出现 """
+
+    def __init__(self):
+        self._families = OrderedDict()
+
+    def declare(self, name, metric_type, help):
+        if name not in self._families:
+            self._families[name] = ["# HELP %s %s" % (name, help), "# TYPE %s %s" % (name, metric_type)]
+
+    def sample(self, name, labels, value, family=None):
+        if labels:
+            line = "%s{%s} %s" % (name, format_labels(labels), value)
+        else:
+            line = "%s %s" % (name, value)
+        self._families[family if family else name].append(line)
+
+    def histogram(self, name, labels, hist):
+        for le, count in hist['buckets'].items():
+            self.sample(name + '_bucket', labels + [('le', le)], count, family=name)
+        self.sample(name + '_sum', labels, hist['sum'], family=name)
+        self.sample(name + '_count', labels, hist['count'], family=name)
+
+    def summary(self, name, labels, latency):
+        # 按周期重置的直方图(wait/service)的 count 每个周期从 0 开始, _count/_sum 使用启动以来的累计值, 保证单调递增
+        for quantile, key in (('0.5', 'p50'), ('0.99', 'p99'), ('0.999', 'p999')):
+            self.sample(name, labels + [('quantile', quantile)], latency[key])
+        self.sample(name + '_sum', labels, latency.get('total_sum', latency['sum']), family=name)
+        self.sample(name + '_count', labels, latency.get('total_count', latency['count']), family=name)
+
+    def render(self):
+        return ''.join('\n'.join(lines) + '\n' for lines in self._families.values())
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        SocketServer.UnixStreamServer.server_bind(self)
+        # BaseHTTPRequestHandler 需要这两个属性
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+class PrometheusHeartBeat(StreamHeartBeat):
+    """
+    在本地端口或 Unix socket 上提供 Prometheus 文本格式的 /metrics
+    计数与队列积压在请求时直接从各 Stream 的共享内存中读取; 每次心跳记录一次计数,
+    用于计算 windows 中各时间窗口(秒)内的平均速率(events/sec)。
+    args:
+        host/port       监听地址, 默认 127.0.0.1:9108
+        unix_socket     配置后监听该 Unix socket, 忽略 host/port
+        windows         速率的时间窗口, 默认 [10, 60]
+    """
+
+    def _init(self, args):
+        self.windows = args.get('windows', [10, 60])
+        self.samples = deque()
+        self.lock = threading.Lock()
+
+        heart_beat = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                try:
+                    body = heart_beat.render()
+                except Exception as e:
+                    logger.error("PrometheusHeartBeat render error: %s" % str(e))
+                    self.send_error(500)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def address_string(self):
+                return str(self.client_address)
+
+            def log_message(self, format, *args):
+                pass
+
+        unix_socket = args.get('unix_socket', None)
+        if unix_socket:
+            self.server = ThreadingUnixHTTPServer(unix_socket, Handler)
+            address = unix_socket
+        else:
+            address = (args.get('host', '127.0.0.1'), args.get('port', 9108))
+            self.server = ThreadingHTTPServer(address, Handler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever, name=self.name)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        logger.info("PrometheusHeartBeat %s listen on %s" % (self.name, address))
+
+    def cancel(self):
+        StreamHeartBeat.cancel(self)
+        server = getattr(self, 'server', None)
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+
+    def heart_beat(self, controller):
+        now = time.time()
+        counts = self.collect_counts(controller.runtime_info)
+        with self.lock:
+            self.samples.append((now, counts))
+            while len(self.samples) > 1 and self.samples[1][0] <= now - max(self.windows):
+                self.samples.popleft()
+
+    @staticmethod
+    def collect_counts(runtime_info):
+        counts = {}
+        for stream_name, _, info in stream_entries(runtime_info):
+            for name, node in info.get('process', {}).items():
+                for k in ('recv', 'emit', 'drop'):
+                    counts[(stream_name, name, k)] = node.get(k, 0)
+            for name, trigger in info.get('trigger', {}).items():
+                counts[(stream_name, name, 'emit')] = trigger.get('emit', 0)
+        return counts
+
+    def rates(self, window, now, counts):
+        # 取窗口起点之前最近的一次采样, 不足一个窗口时使用最早的采样
+        with self.lock:
+            samples = list(self.samples)
+        base = None
+        for ts, sample in samples:
+            if ts > now - window and base is not None:
+                break
+            base = (ts, sample)
+        if base is None or now - base[0] <= 0:
+            return {}
+        elapsed = now - base[0]
+        return dict((k, max(v - base[1].get(k, 0), 0) / elapsed) for k, v in counts.items())
+
+    def render(self):
+        w = MetricWriter()
+        runtime_info = self.controller.runtime_info
+        now = time.time()
+        counts = self.collect_counts(runtime_info)
+        rates = [(window, self.rates(window, now, counts)) for window in self.windows]
+
+        for stream_name, stream_labels, info in stream_entries(runtime_info):
+            for name, trigger in info.get('trigger', {}).items():
+                labels = stream_labels + [('trigger', name.split('.', 1)[-1])]
+                w.declare('proc_stream_trigger_emit_total', 'counter', 'Events emitted by trigger')
+                w.sample('proc_stream_trigger_emit_total', labels, trigger.get('emit', 0))
+                w.declare('proc_stream_trigger_throttled_seconds_total', 'counter', 'Seconds trigger paused by flow control')
+                w.sample('proc_stream_trigger_throttled_seconds_total', labels, trigger.get('throttled', 0))
+                for window, rate in rates:
+                    w.declare('proc_stream_trigger_emit_rate', 'gauge', 'Events/sec emitted by trigger over window')
+                    w.sample('proc_stream_trigger_emit_rate', labels + [('window', "%ss" % window)],
+                             round(rate.get((stream_name, name, 'emit'), 0), 3))
+
+            for name, node in info.get('process', {}).items():
+                labels = stream_labels + [('node', name.split('.', 1)[-1])]
+                for k in ('recv', 'emit', 'drop'):
+                    w.declare('proc_stream_node_events_total', 'counter', 'Events received/emitted/dropped by node')
+                    w.sample('proc_stream_node_events_total', labels + [('type', k)], node.get(k, 0))
+                for window, rate in rates:
+                    for k in ('recv', 'emit', 'drop'):
+                        w.declare('proc_stream_node_events_rate', 'gauge', 'Events/sec of node over window')
+                        w.sample('proc_stream_node_events_rate', labels + [('type', k), ('window', "%ss" % window)],
+                                 round(rate.get((stream_name, name, k), 0), 3))
+                w.declare('proc_stream_node_pending', 'gauge', 'Events waiting in node input queue')
+                w.sample('proc_stream_node_pending', labels, node.get('pending', 0))
+                if 'overflow_drop' in node:
+                    w.declare('proc_stream_node_overflow_drop_total', 'counter', 'Events dropped by full input queue')
+                    w.sample('proc_stream_node_overflow_drop_total', labels, node['overflow_drop'])
+                if 'cpu' in node:
+                    w.declare('proc_stream_node_cpu_seconds_total', 'counter', 'CPU time used by node')
+                    w.sample('proc_stream_node_cpu_seconds_total', labels, node['cpu'])
+                    w.declare('proc_stream_node_cpu_utilization', 'gauge', 'CPU cores used by node')
+                    w.sample('proc_stream_node_cpu_utilization', labels, node['cpu_util'])
+                if 'latency' in node:
+                    w.declare('proc_stream_node_latency_seconds', 'histogram', 'Duration of node proc calls')
+                    w.histogram('proc_stream_node_latency_seconds', labels, node['latency'])
+                if 'wait' in node:
+                    w.declare('proc_stream_node_wait_seconds', 'summary', 'Time events waited before proc, last stats window')
+                    w.summary('proc_stream_node_wait_seconds', labels, node['wait'])
+                    w.declare('proc_stream_node_service_seconds', 'summary', 'Time spent in proc per event, last stats window')
+                    w.summary('proc_stream_node_service_seconds', labels, node['service'])
+                if 'residence' in node:
+                    w.declare('proc_stream_node_residence_seconds', 'summary', 'Sampled time from node input to proc finished')
+                    w.summary('proc_stream_node_residence_seconds', labels, node['residence'])
+
+            if 'end_to_end' in info:
+                w.declare('proc_stream_end_to_end_latency_seconds', 'summary', 'Sampled time from trigger emit to last node finished')
+                w.summary('proc_stream_end_to_end_latency_seconds', stream_labels, info['end_to_end'])
+
+        w.declare('proc_stream_remote_logger_pending', 'gauge', 'Log records waiting for remote loggers')
+        w.sample('proc_stream_remote_logger_pending', [('process', 'controller')],
+                 runtime_info.get('remote_logger_pending', 0))
+        for stream_name, _, info in stream_entries(runtime_info):
+            w.sample('proc_stream_remote_logger_pending', [('process', stream_name)],
+                     info.get('remote_logger_pending', 0))
+        return w.render()
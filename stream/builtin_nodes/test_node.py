@@ -34,6 +34,19 @@ class DelayNode(HandlerProcessNode):
         self.emit(data)
 
 
+class AsyncSleepNode(HandlerProcessNode):
+    """ async 模式示例, 用 sleep 模拟等待外部 I/O """
+
+    def _init(self, args):
+        import trollius
+        self.trollius = trollius
+        self.delay = args.get('delay', 0.1)
+
+    def proc(self, data):
+        yield self.trollius.From(self.trollius.sleep(self.delay))
+        self.emit(data)
+
+
 class AddTailNode(HandlerProcessNode):
 
     def _init(self, node_conf):
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+# standard library modules
+import time
+import threading
+from collections import OrderedDict
+
+from stats import Counter
+from utils import print_traceback
+
+import logger
+
+
+class DagError(Exception):
+    pass
+
+
+def sort_dag(name, nodes, dag):
+    """
+    检查 dag 配置并返回拓扑序, 以及每个节点的前驱节点列表
+    nodes: Stream 中 process 列表(决定同一层节点的顺序)
+    dag: {节点: [后继节点, ...]}, 没有出现在 key 中的节点没有后继
+    """
+    preds = OrderedDict((n, []) for n in nodes)
+    for src, dsts in dag.items():
+        if src not in preds:
+            raise DagError("Stream %s dag node %s is not in process list" % (name, src))
+        if not isinstance(dsts, list):
+            raise DagError("Stream %s dag node %s's successors must be a list" % (name, src))
+        for dst in dsts:
+            if dst not in preds:
+                raise DagError("Stream %s dag node %s is not in process list" % (name, dst))
+            if src in preds[dst]:
+                raise DagError("Stream %s dag edge %s -> %s is duplicated" % (name, src, dst))
+            preds[dst].append(src)
+
+    order = []
+    in_degree = dict((n, len(p)) for n, p in preds.items())
+    ready = [n for n in nodes if in_degree[n] == 0]
+    while ready:
+        n = ready.pop(0)
+        order.append(n)
+        for dst in dag.get(n, []):
+            in_degree[dst] -= 1
+            if in_degree[dst] == 0:
+                ready.append(dst)
+    if len(order) != len(nodes):
+        raise DagError("Stream %s dag has a cycle: %s" % (name, [n for n in nodes if n not in order]))
+    return order, preds
+
+
+class Edge:
+    """ DAG 中的一条边, 记录经过的 Event 数 """
+
+    def __init__(self, dst, target):
+        self.dst = dst
+        self.count = Counter()
+        self._target = target
+
+    def __call__(self, event):
+        self.count.add()
+        self._target(event)
+
+
+class FanOut:
+    """
+    把一个节点(或 Trigger)的输出分发给它的所有后继节点。
+    后继节点为 thread/process/async 模式时, Event 进入各自的输入队列后由各自的 worker 并行处理。
+    """
+
+    def __init__(self, edges, transport):
+        self._edges = edges
+        self._transport = transport
+
+    def __call__(self, event):
+        # 除最后一个分支外, 其余分支按 event_guard 各自持有一份
+        for edge in self._edges[:-1]:
+            edge(self._transport.fork(event))
+        self._edges[-1](event)
+
+    def credit(self):
+        credit = None
+        for edge in self._edges:
+            c = edge.dst.credit()
+            if c is not None and (credit is None or c < credit):
+                credit = c
+        return credit
+
+    def runtime_info(self):
+        return OrderedDict((edge.dst.name, edge.count.value) for edge in self._edges)
+
+
+class JoinBuffer:
+    """
+    merge 节点的汇合缓冲区
+    按 key 字段的值收集所有上游分支的 Event, 全部到齐后按上游的顺序合并(后面分支的字段覆盖前面的),
+    交给 merge 节点处理。超过 timeout 秒仍未到齐的, 合并已经到达的部分后交出。
+    同一个分支在到齐之前又送来相同 key 的 Event 时, 先交出已经到达的部分(计入 duplicated), 新的 Event 重新开始汇合。
+    没有 key 字段的 Event 不做汇合, 直接交给 merge 节点。
+    """
+
+    def __init__(self, name, sources, key, emit, transport, timeout=5):
+        self.name = name
+        self._sources = sources
+        self._keys = key.split('.')
+        self._emit = emit
+        self._transport = transport
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._pending = OrderedDict()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self.sweep_run, name=name + "-join")
+        self._thread.daemon = True
+
+        self.merged = Counter()
+        self.expired = Counter()
+        self.duplicated = Counter()
+
+    def input_from(self, source):
+        def input(raw):
+            self.add(source, raw)
+        return input
+
+    def get_key(self, event):
+        value = event
+        for k in self._keys:
+            if not isinstance(value, dict):
+                return None
+            value = value.get(k, None)
+        return value
+
+    def add(self, source, raw):
+        try:
+            event = self._transport.unpack(raw)
+        except TypeError as e:
+            logger.error("%s join json loads Error:%s" % (self.name, str(e)))
+            return
+        key = self.get_key(event)
+        try:
+            hash(key)
+        except TypeError:
+            key = None
+        if key is None:
+            self._emit(event)
+            return
+
+        flushed = None
+        with self._lock:
+            entry = self._pending.get(key, None)
+            if entry is not None and source in entry[1]:
+                flushed = self._pending.pop(key)[1]
+                entry = None
+            if entry is None:
+                entry = self._pending[key] = (time.time(), {})
+            entry[1][source] = event
+            parts = self._pending.pop(key)[1] if len(entry[1]) == len(self._sources) else None
+        if flushed is not None:
+            self.duplicated.add()
+            logger.info("%s join flush pending event! reason: 'duplicated key %s from %s'" % (self.name, key, source))
+            self.release(flushed)
+        if parts is not None:
+            self.merged.add()
+            self.release(parts)
+
+    def merge(self, parts):
+        merged = {}
+        for source in self._sources:
+            if source in parts:
+                merged.update(parts[source])
+        return self._transport.protect(merged)
+
+    def release(self, parts):
+        try:
+            self._emit(self.merge(parts))
+        except:
+            print_traceback(logger)
+
+    def sweep(self, force=False):
+        expired = []
+        deadline = time.time() - self._timeout
+        with self._lock:
+            while self._pending:
+                key, (start, parts) = next(self._pending.iteritems())
+                if not force and start > deadline:
+                    break
+                del self._pending[key]
+                expired.append(parts)
+        for parts in expired:
+            self.expired.add()
+            self.release(parts)
+
+    def sweep_run(self):
+        interval = min(self._timeout / 2.0, 1)
+        while not self._stopped.wait(interval):
+            self.sweep()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.sweep(force=True)
+
+    def runtime_info(self):
+        info = OrderedDict()
+        info['pending'] = len(self._pending)
+        info['merged'] = self.merged.value
+        info['expired'] = self.expired.value
+        info['duplicated'] = self.duplicated.value
+        return info
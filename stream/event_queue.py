@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+# standard library modules
+import os
+import time
+import Queue
+import ujson
+import tempfile
+import threading
+
+from stats import Counter
+
+import logger
+
+
+class UnknownOverflowPolicy(Exception):
+    pass
+
+
+class SpillFile:
+    """
+    磁盘上的 FIFO, 按行保存json序列化后的 Event, 读空后截断文件
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._count = 0
+        self._writer = open(path, 'ab')
+        self._reader = open(path, 'rb')
+
+    def __len__(self):
+        return self._count
+
+    def push(self, event):
+        line = ujson.dumps(event) + '\n'
+        with self._lock:
+            self._writer.write(line)
+            self._writer.flush()
+            self._count += 1
+
+    def pop(self):
+        with self._lock:
+            if self._count == 0:
+                raise Queue.Empty
+            line = self._reader.readline()
+            self._count -= 1
+            if self._count == 0:
+                self._writer.truncate(0)
+                self._reader.seek(0)
+        return ujson.loads(line)
+
+    def close(self):
+        self._writer.close()
+        self._reader.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class EventQueue:
+    """
+    带溢出策略的节点输入队列, 接口与 Queue.Queue 的 get/put 保持一致
+        block:       阻塞等待 block_timeout 秒, 超时后丢弃
+        drop_oldest: 丢弃队列中最早的 Event 为新 Event 腾出位置
+        drop_newest: 丢弃新来的 Event (默认)
+        spill:       写入磁盘文件, 队列空出后按顺序读回
+    evict_cb: drop_oldest 从队列中丢弃 Event 时以被丢弃的元素调用, put 此时仍返回 True
+    drop_count/throttled_time: 溢出丢弃数与阻塞时间的 Counter, 分区的多个队列共用同一组
+    """
+
+    policies = ('block', 'drop_oldest', 'drop_newest', 'spill')
+
+    def __init__(self, name, maxsize, overflow='drop_newest', block_timeout=1, spill_path=None, evict_cb=None,
+                 drop_count=None, throttled_time=None):
+        if overflow not in self.policies:
+            raise UnknownOverflowPolicy("Node %s overflow policy %s doesn't exist!" % (name, overflow))
+        self.name = name
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self._block_timeout = block_timeout
+        self._evict_cb = evict_cb
+        self._queue = Queue.Queue(maxsize)
+        self._spill = None
+        if overflow == 'spill':
+            spill_path = spill_path if spill_path else tempfile.gettempdir()
+            self._spill = SpillFile(os.path.join(spill_path, "%s.%s.spill" % (name, os.getpid())))
+
+        self._drop_count = drop_count if drop_count is not None else Counter()
+        self._throttled_time = throttled_time if throttled_time is not None else Counter(0.0)
+
+    @property
+    def drop_count(self):
+        return self._drop_count.value
+
+    @property
+    def throttled_time(self):
+        return self._throttled_time.value
+
+    def counters(self):
+        """ runtime info 中由 Counter 原地更新的字段 """
+        return {'overflow_drop': self._drop_count, 'throttled': self._throttled_time}
+
+    def qsize(self):
+        if self._spill is not None:
+            return self._queue.qsize() + len(self._spill)
+        return self._queue.qsize()
+
+    def credit(self):
+        """ 还能无阻塞、无丢弃接收的 Event 数量, None 表示不限制(maxsize <= 0 的队列没有上限) """
+        if self.maxsize <= 0:
+            return None
+        if self._spill is not None and len(self._spill) > 0:
+            return 0
+        return max(self.maxsize - self._queue.qsize(), 0)
+
+    def put(self, event):
+        if self._spill is not None:
+            # spill 中还有数据时, 新的 Event 也要写入 spill, 保证先进先出
+            if len(self._spill) == 0:
+                try:
+                    self._queue.put(event, False)
+                    return True
+                except Queue.Full:
+                    pass
+            self._spill.push(event)
+            return True
+
+        try:
+            self._queue.put(event, False)
+            return True
+        except Queue.Full:
+            pass
+
+        if self.overflow == 'block':
+            start = time.time()
+            try:
+                self._queue.put(event, True, self._block_timeout)
+                return True
+            except Queue.Full:
+                pass
+            finally:
+                self._throttled_time.add(time.time() - start)
+        elif self.overflow == 'drop_oldest':
+            while True:
+                try:
+                    evicted = self._queue.get_nowait()
+                    self._drop_count.add()
+                    logger.info("%s drop oldest event! reason: 'input Queue is full'" % self.name)
+                    if self._evict_cb is not None:
+                        self._evict_cb(evicted)
+                except Queue.Empty:
+                    pass
+                try:
+                    self._queue.put(event, False)
+                    return True
+                except Queue.Full:
+                    continue
+
+        self._drop_count.add()
+        logger.info("%s's filter drop event! reason: 'input Queue is full'" % self.name)
+        return False
+
+    def get(self, block=True, timeout=None):
+        if self._spill is not None and len(self._spill) > 0:
+            try:
+                return self._queue.get_nowait()
+            except Queue.Empty:
+                pass
+            try:
+                return self._spill.pop()
+            except Queue.Empty:
+                pass
+        return self._queue.get(block, timeout)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def close(self):
+        if self._spill is not None:
+            self._spill.close()
+
+
+class EventQueueGroup:
+    """
+    按 partition 函数把 Event 分配到多个 EventQueue, 每个 worker 独占一个队列,
+    同一个 key 的 Event 总是由同一个 worker 按顺序处理。
+    partition 为 None 时所有 worker 共享同一个队列。
+    """
+
+    def __init__(self, name, maxsize, partitions=1, partition=None, overflow='drop_newest', block_timeout=1,
+                 spill_path=None, evict_cb=None):
+        self.name = name
+        self.overflow = overflow
+        self._partition = partition if partitions > 1 else None
+        self._drop_count = Counter()
+        self._throttled_time = Counter(0.0)
+        counters = (evict_cb, self._drop_count, self._throttled_time)
+        if self._partition is None:
+            self._queues = [EventQueue(name, maxsize, overflow, block_timeout, spill_path, *counters)]
+        else:
+            self._queues = [EventQueue("%s#%s" % (name, i), maxsize, overflow, block_timeout, spill_path, *counters)
+                            for i in range(partitions)]
+
+    @property
+    def drop_count(self):
+        return self._drop_count.value
+
+    @property
+    def throttled_time(self):
+        return self._throttled_time.value
+
+    def counters(self):
+        return {'overflow_drop': self._drop_count, 'throttled': self._throttled_time}
+
+    def is_partitioned(self):
+        return self._partition is not None
+
+    def queue_for(self, index):
+        if self._partition is None:
+            return self._queues[0]
+        return self._queues[index]
+
+    def qsize(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def partition_qsize(self):
+        return [q.qsize() for q in self._queues]
+
+    def credit(self):
+        # 任意一个分区饱和都需要让上游减速
+        credits = [c for c in (q.credit() for q in self._queues) if c is not None]
+        return min(credits) if credits else None
+
+    def put(self, event):
+        if self._partition is None:
+            return self._queues[0].put(event)
+        return self._queues[self._partition(event, len(self._queues))].put(event)
+
+    def close(self):
+        for q in self._queues:
+            q.close()
@@ -15,6 +15,7 @@ g_logger_level = "debug"
 g_logger_name = "main"
 g_logger_path = "/var/log/"
 g_console_log = False
+g_debug_enabled = True
 
 
 g_local_logger = None
@@ -32,6 +33,11 @@ __log_level__ = {
 }
 
 
+def debug_enabled():
+    """ 热路径上在格式化 debug 日志之前先判断, 避免无用的字符串格式化 """
+    return g_debug_enabled
+
+
 def remote_logger_pending_count():
     global g_remote_logger
     return g_remote_logger.get_pending_count()
@@ -215,6 +221,7 @@ def init(name=None):
     global g_logger_level
     global g_logger_path
     global g_console_log
+    global g_debug_enabled
 
     if not name:
         name = g_logger_name
@@ -234,6 +241,9 @@ def init(name=None):
     remote_logger.start()
     g_local_logger.log("info", "Process %s's custom logger start" % (g_logger_name))
 
+    g_debug_enabled = __log_level__[g_logger_level] <= __log_level__['debug'] or \
+        any(l.enable and __log_level__[l.level] <= __log_level__['debug'] for l in remote_logger.loggers)
+
     g_remote_logger = remote_logger
 
 
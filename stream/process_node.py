@@ -3,13 +3,23 @@
 __author__ = "cinojseph"
 
 # standard library modules
-import ujson
+import sys
 import time
+import types
 import Queue
+import signal
+import ujson
 import hashlib
 import threading
+import multiprocessing
+from collections import OrderedDict
 
 from utils import print_traceback
+from transport import Transport
+from event_queue import EventQueue, EventQueueGroup
+from reorder import ReorderBuffer
+from stats import Counter, Histogram, HdrHistogram, WindowHistogram, CpuUsage, process_cpu_time
+from dag import FanOut
 
 from lib.mini_ruler.ruler import Ruler, RulerNoMatch
 
@@ -64,6 +74,11 @@ class OutputProcessNode(object):
     def proc(self, data):
         raise NodeNotImplement
 
+    def proc_batch(self, events):
+        # 配置了 batch_size 时, worker 会一次性交出一批 Event; 需要批量处理的节点重写此函数
+        for data in events:
+            self.proc(data)
+
 
 class HandlerProcessNode(object):
 
@@ -99,26 +114,211 @@ class HandlerProcessNode(object):
     def proc(self, data):
         raise NodeNotImplement
 
+    def proc_batch(self, events):
+        # 配置了 batch_size 时, worker 会一次性交出一批 Event; 需要批量处理的节点重写此函数
+        for data in events:
+            self.proc(data)
+
+
+class BatchHistogram:
+    """ 批大小分布, key 为 2 的幂, 表示批大小 <= key 的次数 """
+
+    def __init__(self, batch_size):
+        self._buckets = []
+        bucket = 1
+        while True:
+            self._buckets.append(bucket)
+            if bucket >= batch_size:
+                break
+            bucket *= 2
+        self._counts = [0] * len(self._buckets)
+
+    def add(self, n):
+        for i, bucket in enumerate(self._buckets):
+            if n <= bucket:
+                self._counts[i] += 1
+                return
+        self._counts[-1] += 1
+
+    def dump(self):
+        return OrderedDict((str(bucket), self._counts[i]) for i, bucket in enumerate(self._buckets))
+
+
+def queue_runtime_info(event_queue):
+    info = OrderedDict()
+    info['overflow'] = event_queue.overflow
+    info['overflow_drop'] = event_queue.drop_count
+    info['throttled'] = round(event_queue.throttled_time, 3)
+    if isinstance(event_queue, EventQueueGroup) and event_queue.is_partitioned():
+        info['partitions'] = event_queue.partition_qsize()
+    return info
+
+
+def create_partitioner(partition_by):
+    """
+    根据 Event 中 partition_by 字段(支持 a.b.c 形式)的值计算分区号, 字段路径在此预先拆分。
+    使用 md5 而不是 hash(), 保证同一个 key 在不同进程、不同次启动中分到同一个分区。
+    """
+    if not partition_by:
+        return None
+    keys = partition_by.split('.')
+
+    def partition(item, partitions):
+        value = item[0]
+        for k in keys:
+            if not isinstance(value, dict):
+                value = None
+                break
+            value = value.get(k, None)
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return int(hashlib.md5(str(value)).hexdigest()[:8], 16) % partitions
+
+    return partition
+
+
+def get_event_batch(event_queue, batch_size, linger, poll_timeout):
+    """
+    阻塞等待第一个 Event, 之后在 linger 时间内继续收集, 直到凑满 batch_size 个或超时
+    队列为空时抛出 Queue.Empty
+    """
+    batch = [event_queue.get(True, poll_timeout)]
+    if batch_size <= 1:
+        return batch
+    deadline = time.time() + linger
+    while len(batch) < batch_size:
+        try:
+            timeout = deadline - time.time()
+            if timeout > 0:
+                batch.append(event_queue.get(True, timeout))
+            else:
+                batch.append(event_queue.get_nowait())
+        except Queue.Empty:
+            break
+    return batch
+
+
+# 当前线程正在处理的 Event 的上下文(ctx), worker 在调用 proc 前设置,
+# 节点在 proc 中 emit 时, controller 据此得知新 Event 来自哪个输入 Event
+_event_context = threading.local()
+
+
+def get_event_context():
+    return getattr(_event_context, 'ctx', None)
+
+
+def set_event_context(ctx):
+    prev = getattr(_event_context, 'ctx', None)
+    _event_context.ctx = ctx
+    return prev
+
+
+def proc_event(processer, event, ctx, finish_cb):
+    prev = set_event_context(ctx)
+    try:
+        processer.proc(event)
+    except:
+        print_traceback(logger)
+    finally:
+        set_event_context(prev)
+        if ctx is not None:
+            finish_cb(ctx)
+
+
+def proc_event_batch(processer, batch, finish_cb):
+    # batch 中每一项为 (event, ctx) 或 (event, ctx, 入队时间)
+    try:
+        processer.proc_batch([item[0] for item in batch])
+    except:
+        print_traceback(logger)
+    finally:
+        for item in batch:
+            if item[1] is not None:
+                finish_cb(item[1])
+
+
+def evict_callback(finish_cb):
+    """
+    drop_oldest 从输入队列中丢弃的 Event 不会再有 worker 处理, 有序模式下需要标记完成,
+    否则 ReorderBuffer 会一直等待它的序号
+    """
+    def evicted(item):
+        if item[1] is not None:
+            finish_cb(item[1])
+    return evicted
+
+
+def filter_batch(batch, filter_cb, finish_cb):
+    """
+    filter_in_worker 时在 worker 中执行节点的 Filter, 返回需要交给 proc 处理的 Event,
+    被 CONTINUE/DROP 的 Event 已由 filter_cb 处理, 这里直接标记完成
+    """
+    if filter_cb is None:
+        return batch
+    accepted = []
+    for item in batch:
+        if filter_cb(item[0], item[1]):
+            accepted.append(item)
+        elif item[1] is not None:
+            finish_cb(item[1])
+    return accepted
+
 
 class ProcessNodeCoroutine:
 
-    def __init__(self, name, cls, args, controller_emit_cb, poll_timeout=1, pool_size=1, queue_size=10000):
+    def __init__(self, name, cls, args, controller_emit_cb, poll_timeout=1, pool_size=1, queue_size=10000,
+                 batch_size=None, batch_linger=0, overflow='drop_newest', block_timeout=1, spill_path=None,
+                 partition_by=None, controller_finish_cb=None, ordered=False, controller_filter_cb=None,
+                 min_pool=None, max_pool=None, scale_interval=1, stats_window=10):
         self.name = name + "-unit[c]"
         self.processer = cls(self.name, args, controller_emit_cb)
+        self._controller_finish_cb = controller_finish_cb
+        # 上游是线程池时会有多个线程同时调用 input, 而节点实例本身不是线程安全的;
+        # 需要并行处理的节点应使用 thread/process/async 模式
+        self._proc_lock = threading.Lock()
+        # wait: 等待 proc 锁的时间(single 模式没有输入队列), service: proc 的耗时, latency 由 service 换算
+        self._wait = WindowHistogram(stats_window)
+        self._service = WindowHistogram(stats_window)
+        self._cpu = CpuUsage()
 
     def get_event_pending_count(self):
         return 0
 
+    def get_credit(self):
+        # 在调用者线程中直接处理, 没有输入队列, 不限制上游
+        return None
+
+    def counters(self):
+        return {}
+
+    def enable_cpu_stats(self):
+        self._cpu.enable()
+
+    def runtime_info(self):
+        info = OrderedDict()
+        info['latency'] = self._service.dump_total()
+        info['wait'] = self._wait.dump()
+        info['service'] = self._service.dump()
+        if self._cpu.enabled:
+            info.update(self._cpu.dump())
+        return info
+
     def get_pool(self):
         return [self]
 
-    def input(self, event):
+    def input(self, event, ctx=None):
         if None == self.processer:
             raise PoolNotReady
-        try:
-            self.processer.proc(event)
-        except:
-            print_traceback(logger)
+        arrive = time.time()
+        with self._proc_lock:
+            start = time.time()
+            cpu = self._cpu.begin()
+            proc_event(self.processer, event, ctx, self._controller_finish_cb)
+            self._cpu.end(cpu)
+            elapsed = time.time() - start
+        self._wait.observe(start - arrive)
+        self._service.observe(elapsed)
+        return True
 
     def start(self):
         logger.debug("  |- Start Proc Node %s" % self.name)
@@ -133,151 +333,922 @@ class ProcessNodeCoroutine:
 
 class ProcessNodeThread:
 
-    def __init__(self, name, cls, args, controller_emit_cb, poll_timeout=1, pool_size=1, queue_size=10000):
+    default_batch_size = 1
+
+    # 自动伸缩: 连续 scale_up_intervals 个周期有积压且积压未减少(或 worker 繁忙)时增加一个 worker,
+    # 连续 scale_down_intervals 个周期没有积压且 worker 空闲时减少一个 worker
+    busy_high = 0.8
+    busy_low = 0.3
+    scale_up_intervals = 2
+    scale_down_intervals = 5
+
+    def __init__(self, name, cls, args, controller_emit_cb, poll_timeout=1, pool_size=1, queue_size=10000,
+                 batch_size=None, batch_linger=0, overflow='drop_newest', block_timeout=1, spill_path=None,
+                 partition_by=None, controller_finish_cb=None, ordered=False, controller_filter_cb=None,
+                 min_pool=None, max_pool=None, scale_interval=1, stats_window=10):
         self.name = name
+        self._cls = cls
+        self._args = args
+        self._controller_emit_cb = controller_emit_cb
         self._poll_timeout = poll_timeout
-        self._event_queue = Queue.Queue(queue_size)
+        self._event_queue = EventQueueGroup(name, queue_size, partitions=pool_size,
+                                            partition=create_partitioner(partition_by), overflow=overflow,
+                                            block_timeout=block_timeout, spill_path=spill_path,
+                                            evict_cb=evict_callback(controller_finish_cb) if ordered else None)
+        self._batch_size = batch_size if batch_size else self.default_batch_size
+        if ordered and self._batch_size > 1:
+            # proc_batch 中 emit 的 Event 无法对应到输入 Event, 有序模式下逐个处理
+            logger.warning("%s is ordered, ignore batch_size %s" % (self.name, self._batch_size))
+            self._batch_size = 1
+        self._batch_linger = batch_linger
+        self._batch_histogram = BatchHistogram(self._batch_size)
+        self._controller_finish_cb = controller_finish_cb
+        self._controller_filter_cb = controller_filter_cb
+
+        self._min_pool = min_pool if min_pool else pool_size
+        self._max_pool = max_pool if max_pool else pool_size
+        self._autoscale = self._max_pool > self._min_pool
+        if self._autoscale and self._event_queue.is_partitioned():
+            # 分区数在启动时确定, 分区的 worker 不能增减
+            logger.warning("%s is partitioned, ignore min_pool/max_pool" % self.name)
+            self._autoscale = False
+        if self._autoscale:
+            pool_size = min(max(pool_size, self._min_pool), self._max_pool)
+        self._scale_interval = scale_interval
+        self._scale_lock = threading.Lock()
+        self._scale_stop = threading.Event()
+        self._scaler = threading.Thread(target=self.scale_run, name=self.name + "-scaler")
+        self._busy_time = Counter(0.0)
+        # wait: Event 在输入队列中等待的时间, service: 每个 Event 的处理耗时(batch 按 Event 数平均)
+        # latency 为一次处理的耗时, 不使用 batch 时与 service 相同, 由 service 换算而不重复记录
+        self._latency = Histogram() if self._batch_size > 1 else None
+        self._wait = WindowHistogram(stats_window)
+        self._service = WindowHistogram(stats_window)
+        self._cpu = CpuUsage()
+        self._busy_ratio = 0.0
+        self._scale_up_count = 0
+        self._scale_down_count = 0
+        self._last_scale = None
+        self._unit_index = 0
 
         self._pool = []
+        self._retired = []
         for i in range(pool_size):
-            name = self.name + "-unit." + str(i + 1) + "[t]"
-            processer = cls(self.name, args, controller_emit_cb)
-            dismissed = threading.Event()
-            start_success = threading.Event()
-            thread = threading.Thread(target=self.thread_run, name=name,
-                                      args=(processer, dismissed, start_success))
-
-            self._pool.append((thread, dismissed, start_success))
+            self._pool.append(self.create_unit(self._event_queue.queue_for(i)))
+
+    def create_unit(self, event_queue):
+        self._unit_index += 1
+        name = self.name + "-unit." + str(self._unit_index) + "[t]"
+        processer = self._cls(self.name, self._args, self._controller_emit_cb)
+        dismissed = threading.Event()
+        start_success = threading.Event()
+        retired = threading.Event()
+        thread = threading.Thread(target=self.thread_run, name=name,
+                                  args=(processer, event_queue, dismissed, start_success, retired))
+        return thread, dismissed, start_success, retired
+
+    def start_unit(self, unit):
+        t, start_success = unit[0], unit[2]
+        t.start()
+        if not start_success.wait(10):
+            # TODO: 是否需要强行杀死该线程？
+            raise ProcThreadInitError("proc thread %s init timeout" % t.name)
+        logger.debug("  |  |- Start Proc Unit %s id:%s" % (t.name, id(t)))
 
     def get_event_pending_count(self):
         return self._event_queue.qsize()
 
+    def get_credit(self):
+        return self._event_queue.credit()
+
+    def counters(self):
+        return self._event_queue.counters()
+
+    def enable_cpu_stats(self):
+        self._cpu.enable()
+
+    def runtime_info(self):
+        info = queue_runtime_info(self._event_queue)
+        if self._batch_size > 1:
+            info['batch'] = self._batch_histogram.dump()
+        if self._latency is not None:
+            info['latency'] = self._latency.dump()
+        else:
+            info['latency'] = self._service.dump_total()
+        info['wait'] = self._wait.dump()
+        info['service'] = self._service.dump()
+        if self._cpu.enabled:
+            info.update(self._cpu.dump())
+        if self._autoscale:
+            info['pool'] = len(self._pool)
+            info['min_pool'] = self._min_pool
+            info['max_pool'] = self._max_pool
+            info['busy'] = round(self._busy_ratio, 3)
+            info['scale_up'] = self._scale_up_count
+            info['scale_down'] = self._scale_down_count
+            info['last_scale'] = self._last_scale
+        return info
+
     def get_pool(self):
         return [node[0] for node in self._pool]
 
-    def input(self, event):
-        try:
-            self._event_queue.put(event, False)
-        except Queue.Full:
-            logger.info("%s's filter drop event! reason: 'input Queue is full'" % self.name)
+    def input(self, event, ctx=None):
+        return self._event_queue.put((event, ctx, time.time()))
 
-    def thread_run(self, processer, dismissed, start_success):
+    def thread_run(self, processer, event_queue, dismissed, start_success, retired):
         try:
             processer.initialize()
         except:
             print_traceback(logger)
-
         start_success.set()
-        while True:
+        while not retired.is_set():
             try:
-                event = self._event_queue.get(True, self._poll_timeout)
+                batch = get_event_batch(event_queue, self._batch_size, self._batch_linger, self._poll_timeout)
             except Queue.Empty:
                 if dismissed.is_set():
                     break
                 continue
+            start = time.time()
+            cpu = self._cpu.begin()
+            for item in batch:
+                self._wait.observe(start - item[2])
+            batch = filter_batch(batch, self._controller_filter_cb, self._controller_finish_cb)
+            if not batch:
+                self._cpu.end(cpu)
+                continue
+            if self._batch_size > 1:
+                self._batch_histogram.add(len(batch))
+                proc_event_batch(processer, batch, self._controller_finish_cb)
             else:
+                proc_event(processer, batch[0][0], batch[0][1], self._controller_finish_cb)
+            self._cpu.end(cpu)
+            elapsed = time.time() - start
+            self._busy_time.add(elapsed)
+            if self._latency is None:
+                self._service.observe(elapsed)
+            else:
+                self._latency.observe(elapsed)
+                service = elapsed / len(batch)
+                for _ in batch:
+                    self._service.observe(service)
+        processer.finish()
+
+    def scale_run(self):
+        last_pending = 0
+        last_busy = self._busy_time.value
+        last_time = time.time()
+        up_streak, down_streak = 0, 0
+        while not self._scale_stop.wait(self._scale_interval):
+            now = time.time()
+            busy = self._busy_time.value
+            workers = len(self._pool)
+            self._busy_ratio = min((busy - last_busy) / ((now - last_time) * workers), 1.0)
+            last_busy, last_time = busy, now
+            pending = self._event_queue.qsize()
+
+            if (pending > workers and pending >= last_pending) or self._busy_ratio > self.busy_high:
+                up_streak, down_streak = up_streak + 1, 0
+            elif pending == 0 and self._busy_ratio < self.busy_low:
+                up_streak, down_streak = 0, down_streak + 1
+            else:
+                up_streak, down_streak = 0, 0
+            last_pending = pending
+
+            reason = "pending=%s busy=%.2f" % (pending, self._busy_ratio)
+            if up_streak >= self.scale_up_intervals and workers < self._max_pool:
+                self.scale_to(workers + 1, reason)
+                up_streak = 0
+            elif down_streak >= self.scale_down_intervals and workers > self._min_pool:
+                self.scale_to(workers - 1, reason)
+                down_streak = 0
+
+    def scale_to(self, size, reason):
+        with self._scale_lock:
+            workers = len(self._pool)
+            if size > workers:
+                unit = self.create_unit(self._event_queue.queue_for(0))
+                try:
+                    self.start_unit(unit)
+                except ProcThreadInitError as e:
+                    logger.error("%s scale up failed: %s" % (self.name, str(e)))
+                    return
+                self._pool.append(unit)
+                self._scale_up_count += 1
+            elif size < workers:
+                # 退出的 worker 处理完手头的 Event 后结束, 在 stop 时回收
+                unit = self._pool.pop()
+                unit[3].set()
+                self._retired.append(unit)
+                self._scale_down_count += 1
+            else:
+                return
+            self._last_scale = "%s -> %s, %s" % (workers, size, reason)
+        logger.info("%s scale workers %s" % (self.name, self._last_scale))
+
+    def start(self):
+        logger.debug("  |-Start Proc Node %s" % self.name)
+        for unit in self._pool:
+            self.start_unit(unit)
+        if self._autoscale:
+            self._scaler.start()
+
+    def stop(self):
+
+        logger.debug("  |- Stop Proc Node %s" % self.name)
+        if self._autoscale:
+            self._scale_stop.set()
+            self._scaler.join()
+        for _, dismissed, _, _ in self._pool:
+            if not dismissed.is_set():
+                dismissed.set()
+
+        while True:
+            logger.info("%s _wait_for_all_msg_finish, unfinished: %s" % (self.name, self._event_queue.qsize()))
+            time.sleep(self._poll_timeout)
+            if 0 == self._event_queue.qsize():
+                break
+
+        for t, _, _, _ in self._pool + self._retired:
+            t.join()
+            logger.debug("  |  |- Stop Proc Unit %s id:%s" % (t.name, id(t)))
+        self._event_queue.close()
+
+
+class ProcessNodeOutputLane(ProcessNodeThread):
+    """
+    single 模式 output 节点的 fire-and-forget 通道: 有界的输入队列 + 独立的 worker 线程。
+    controller 把 Event 放入队列后立即发送给下一个节点, sink 的快慢不会增加 handler 链的延迟;
+    sink 跟不上时按 overflow 策略处理, drop_newest/drop_oldest/spill 下不会让上游减速。
+    """
+
+    def __init__(self, name, cls, args, controller_emit_cb, poll_timeout=1, pool_size=1, queue_size=10000,
+                 batch_size=None, batch_linger=0, overflow='drop_newest', block_timeout=1, spill_path=None,
+                 partition_by=None, controller_finish_cb=None, ordered=False, controller_filter_cb=None,
+                 min_pool=None, max_pool=None, scale_interval=1, stats_window=10):
+        ProcessNodeThread.__init__(self, name, cls, args, controller_emit_cb, poll_timeout=poll_timeout,
+                                   pool_size=pool_size, queue_size=queue_size, batch_size=batch_size,
+                                   batch_linger=batch_linger, overflow=overflow, block_timeout=block_timeout,
+                                   spill_path=spill_path, partition_by=partition_by,
+                                   controller_finish_cb=self.lane_finish_callback, min_pool=min_pool,
+                                   max_pool=max_pool, scale_interval=scale_interval, stats_window=stats_window)
+        self._lane_finish_cb = controller_finish_cb
+        self._backpressure = overflow == 'block'
+        self._lag = 0.0
+        self._lag_max = 0.0
+
+    def get_credit(self):
+        # 只有 block 策略需要让上游减速, 其余策略下 sink 积压不影响 handler 链
+        if self._backpressure:
+            return ProcessNodeThread.get_credit(self)
+        return None
+
+    def runtime_info(self):
+        info = ProcessNodeThread.runtime_info(self)
+        info['lag'] = round(self._lag, 3)
+        info['lag_max'] = round(self._lag_max, 3)
+        return info
+
+    def input(self, event, ctx=None):
+        # 采样的 Event 由 controller 传入带有 ts 的 ctx
+        now = time.time()
+        return self._event_queue.put((event, ctx if ctx is not None else {'ts': now}, now))
+
+    def lane_finish_callback(self, ctx):
+        # lag: Event 从进入队列到 sink 处理完成的秒数
+        lag = time.time() - ctx['ts']
+        self._lag = lag
+        if lag > self._lag_max:
+            self._lag_max = lag
+        if self._lane_finish_cb is not None:
+            self._lane_finish_cb(ctx)
+
+
+def process_worker_main(name, cls, args, conn, per_event=False):
+    """
+    process 模式下 worker 进程的主函数
+    父进程通过 pipe 发送一批序列化后的 Event, worker 调用 proc_batch, 并将这一批处理过程中
+    emit 的 Event 序列化后一次性返回给父进程。收到空数据时退出。
+    per_event 时逐个调用 proc, 按输入 Event 分组返回各自 emit 的 Event。
+    """
+    logger.init(name)
+    # 继承自 Stream 进程的 profiler 信号处理不适用于 worker 进程, 忽略该信号, 以免打断 pipe 的读写
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    emitted = []
+    processer = cls(name, args, emitted.append)
+    try:
+        processer.initialize()
+    except:
+        print_traceback(logger)
+    conn.send_bytes('ready')
+
+    while True:
+        try:
+            raw = conn.recv_bytes()
+        except EOFError:
+            break
+        if not raw:
+            break
+        groups = []
+        if per_event:
+            for event in ujson.loads(raw):
                 try:
                     processer.proc(event)
                 except:
                     print_traceback(logger)
-        processer.finish()
+                groups.append(list(emitted))
+                del emitted[:]
+        else:
+            try:
+                processer.proc_batch(ujson.loads(raw))
+            except:
+                print_traceback(logger)
+            groups.append(emitted)
+        conn.send_bytes(ujson.dumps(groups))
+        del emitted[:]
+
+    processer.finish()
+    conn.close()
+    logger.fini()
+
+
+class ProcessNodeProcess:
+    """
+    预先 fork 的 worker 进程池。每个 worker 进程对应父进程中的一个分发线程,
+    分发线程从输入队列中批量取出 Event, 经 pipe 交给 worker 进程处理, 再把 worker
+    emit 的结果交回 Stream 的 emit 链。Event 只在这里跨越进程边界时做序列化。
+    """
+
+    default_batch_size = 64
+    # 重启 worker 进程失败后重试的最长间隔(秒), 间隔从 1 秒开始逐次翻倍
+    respawn_backoff_max = 30
+
+    def __init__(self, name, cls, args, controller_emit_cb, poll_timeout=1, pool_size=1, queue_size=10000,
+                 batch_size=None, batch_linger=0, overflow='drop_newest', block_timeout=1, spill_path=None,
+                 partition_by=None, controller_finish_cb=None, ordered=False, controller_filter_cb=None,
+                 min_pool=None, max_pool=None, scale_interval=1, stats_window=10):
+        self.name = name
+        self._cls = cls
+        self._args = args
+        self._controller_emit_cb = controller_emit_cb
+        self._poll_timeout = poll_timeout
+        self._event_queue = EventQueueGroup(name, queue_size, partitions=pool_size,
+                                            partition=create_partitioner(partition_by), overflow=overflow,
+                                            block_timeout=block_timeout, spill_path=spill_path,
+                                            evict_cb=evict_callback(controller_finish_cb) if ordered else None)
+        self._batch_size = batch_size if batch_size else self.default_batch_size
+        self._batch_linger = batch_linger
+        self._batch_histogram = BatchHistogram(self._batch_size)
+        self._controller_finish_cb = controller_finish_cb
+        self._controller_filter_cb = controller_filter_cb
+        self._per_event = ordered
+        self._inflight_count = 0
+        self._inflight_lock = threading.Lock()
+        self._latency = Histogram()
+        # 分发线程中的序列化等开销, 加上各 worker 进程的 CPU 时间; 重启的 worker 进程的 CPU 时间记入 _cpu_exited
+        self._cpu = CpuUsage()
+        self._worker_cpu = {}
+        self._cpu_exited = 0.0
+
+        self._pool = []
+        for i in range(pool_size):
+            name = self.name + "-unit." + str(i + 1) + "[p]"
+            # [分发线程, dismissed, (worker进程, pipe)]
+            unit = [None, threading.Event(), None]
+            unit[0] = threading.Thread(target=self.dispatch_run, name=name,
+                                       args=(unit, self._event_queue.queue_for(i)))
+            self._pool.append(unit)
+
+    def get_event_pending_count(self):
+        return self._event_queue.qsize() + self._inflight_count
+
+    def get_credit(self):
+        return self._event_queue.credit()
+
+    def counters(self):
+        return self._event_queue.counters()
+
+    def enable_cpu_stats(self):
+        self._cpu.enable()
+
+    def runtime_info(self):
+        info = queue_runtime_info(self._event_queue)
+        info['batch'] = self._batch_histogram.dump()
+        info['latency'] = self._latency.dump()
+        if self._cpu.enabled:
+            info.update(self._cpu.dump(self._cpu.value + self.worker_cpu_time()))
+        return info
+
+    def worker_cpu_time(self):
+        total = self._cpu_exited
+        for unit in self._pool:
+            if unit[2] is None:
+                continue
+            pid = unit[2][0].pid
+            cpu = process_cpu_time(pid)
+            if cpu is not None:
+                self._worker_cpu[pid] = cpu
+            total += self._worker_cpu.get(pid, 0.0)
+        return total
+
+    def get_pool(self):
+        return [unit[0] for unit in self._pool]
+
+    def input(self, event, ctx=None):
+        return self._event_queue.put((event, ctx))
+
+    def _add_inflight(self, n):
+        with self._inflight_lock:
+            self._inflight_count += n
+
+    def spawn_worker(self, name):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=process_worker_main, name=name,
+                                          args=(name, self._cls, self._args, child_conn, self._per_event))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        try:
+            if not parent_conn.poll(10):
+                raise ProcThreadInitError("proc process %s init timeout" % name)
+            parent_conn.recv_bytes()
+        except (EOFError, IOError, ProcThreadInitError):
+            parent_conn.close()
+            if process.is_alive():
+                process.terminate()
+            process.join(1)
+            raise
+        return process, parent_conn
+
+    def respawn_worker(self, unit):
+        """
+        回收失去联系的 worker 进程并重新启动, 启动失败时退避后重试, 直到成功为止;
+        分发线程不能退出, 否则它负责的那部分输入队列不再有人处理, 在流控下会使 Trigger 停顿
+        """
+        name = unit[0].name
+        process, conn = unit[2]
+        unit[2] = None
+        conn.close()
+        process.join(1)
+        if process.is_alive():
+            logger.error("%s worker process %s is still alive, terminate it" % (self.name, name))
+            process.terminate()
+            process.join(1)
+        self._cpu_exited += self._worker_cpu.pop(process.pid, 0.0)
+        backoff = 1
+        while True:
+            try:
+                unit[2] = self.spawn_worker(name)
+                return
+            except Exception as e:
+                logger.error("%s respawn worker process %s failed: %s, retry in %ss" % (self.name, name, str(e), backoff))
+            time.sleep(backoff)
+            backoff = min(backoff * 2, self.respawn_backoff_max)
+
+    def dispatch_run(self, unit, event_queue):
+        thread, dismissed = unit[0], unit[1]
+        while True:
+            try:
+                batch = get_event_batch(event_queue, self._batch_size, self._batch_linger, self._poll_timeout)
+            except Queue.Empty:
+                if dismissed.is_set():
+                    break
+                continue
+            cpu = self._cpu.begin()
+            batch = filter_batch(batch, self._controller_filter_cb, self._controller_finish_cb)
+            if not batch:
+                self._cpu.end(cpu)
+                continue
+
+            self._batch_histogram.add(len(batch))
+            process, conn = unit[2]
+            self._add_inflight(len(batch))
+            start = time.time()
+            try:
+                conn.send_bytes(ujson.dumps([event for event, _ in batch]))
+                groups = ujson.loads(conn.recv_bytes())
+                self._latency.observe(time.time() - start)
+            except (EOFError, IOError) as e:
+                logger.error("%s worker process %s lost: %s, %s events dropped, respawn it"
+                             % (self.name, thread.name, str(e), len(batch)))
+                self.respawn_worker(unit)
+                groups = []
+            except Exception as e:
+                # Event 无法序列化等错误, 与 worker 的通信没有中断, 丢弃这一批 Event
+                logger.error("%s dispatch error: %s, %s events dropped" % (self.name, str(e), len(batch)))
+                print_traceback(logger)
+                groups = []
+            finally:
+                self._add_inflight(-len(batch))
+
+            if len(groups) == len(batch):
+                # 每个输入 Event 各自 emit 的结果, 在对应的 ctx 下交回 emit 链
+                for (_, ctx), emitted in zip(batch, groups):
+                    self.emit_results(emitted, ctx)
+            else:
+                for emitted in groups:
+                    self.emit_results(emitted, None)
+                for _, ctx in batch:
+                    if ctx is not None:
+                        self._controller_finish_cb(ctx)
+            self._cpu.end(cpu)
+
+        process, conn = unit[2]
+        try:
+            conn.send_bytes('')
+        except (EOFError, IOError):
+            pass
+        process.join(self._poll_timeout * 10)
+        if process.is_alive():
+            logger.error("%s worker process %s join timeout, terminate it" % (self.name, thread.name))
+            process.terminate()
+        conn.close()
+
+    def emit_results(self, emitted, ctx):
+        prev = set_event_context(ctx)
+        try:
+            for event in emitted:
+                try:
+                    self._controller_emit_cb(event)
+                except:
+                    print_traceback(logger)
+        finally:
+            set_event_context(prev)
+            if ctx is not None:
+                self._controller_finish_cb(ctx)
 
     def start(self):
         logger.debug("  |-Start Proc Node %s" % self.name)
-        for t, _, start_success in self._pool:
+        for unit in self._pool:
+            t = unit[0]
+            unit[2] = self.spawn_worker(t.name)
             t.start()
-            if not start_success.wait(10):
-                # TODO: 是否需要强行杀死该线程？
-                raise ProcThreadInitError("proc thread %s init timeout" % t.name)
-            logger.debug("  |  |- Start Proc Unit %s id:%s" % (t.name, id(t)))
+            logger.debug("  |  |- Start Proc Unit %s pid:%s" % (t.name, unit[2][0].pid))
 
     def stop(self):
-
         logger.debug("  |- Stop Proc Node %s" % self.name)
         for _, dismissed, _ in self._pool:
             if not dismissed.is_set():
                 dismissed.set()
 
         while True:
-            logger.info("%s _wait_for_all_msg_finish, unfinished: %s" % (self.name, self._event_queue.qsize()))
+            logger.info("%s _wait_for_all_msg_finish, unfinished: %s" % (self.name, self.get_event_pending_count()))
             time.sleep(self._poll_timeout)
-            if 0 == self._event_queue.qsize():
+            if 0 == self.get_event_pending_count():
                 break
 
         for t, _, _ in self._pool:
             t.join()
             logger.debug("  |  |- Stop Proc Unit %s id:%s" % (t.name, id(t)))
+        self._event_queue.close()
+
+
+def import_trollius():
+    # async 模式依赖 trollius (python2 的 asyncio), 只在使用时才导入
+    try:
+        import trollius
+    except ImportError:
+        raise Exception("Node mode async requires the `trollius` package")
+    return trollius
+
+
+class ProcessNodeAsync:
+    """
+    async 模式: 每个节点一个线程运行 trollius event loop, 节点的 proc 可以返回一个协程(或Future),
+    loop 中最多同时运行 pool_size(即配置中的 concurrency) 个 proc。
+    适合大部分时间在等待 broker/Redis/HTTP 的 I/O 型节点。
+    """
+
+    def __init__(self, name, cls, args, controller_emit_cb, poll_timeout=1, pool_size=100, queue_size=10000,
+                 batch_size=None, batch_linger=0, overflow='drop_newest', block_timeout=1, spill_path=None,
+                 partition_by=None, controller_finish_cb=None, ordered=False, controller_filter_cb=None,
+                 min_pool=None, max_pool=None, scale_interval=1, stats_window=10):
+        self._trollius = import_trollius()
+        self.name = name + "-unit[a]"
+        self._poll_timeout = poll_timeout
+        self._concurrency = pool_size
+        self._event_queue = EventQueue(name, queue_size, overflow=overflow, block_timeout=block_timeout,
+                                       spill_path=spill_path,
+                                       evict_cb=evict_callback(controller_finish_cb) if ordered else None)
+        self._inflight_count = 0
+        self._latency = Histogram()
+        self._cpu = CpuUsage()
+        self._wakeup_pending = False
+        self._controller_finish_cb = controller_finish_cb
+        self._controller_filter_cb = controller_filter_cb
+        self.processer = cls(self.name, args, controller_emit_cb)
+        self._loop = self._trollius.new_event_loop()
+        self._start_success = threading.Event()
+        self._thread = threading.Thread(target=self.loop_run, name=self.name)
 
+    def get_event_pending_count(self):
+        return self._event_queue.qsize() + self._inflight_count
 
-class ProcessNodeProcess():
-    # TODO: 实现进程节点, 日后再说
-    pass
+    def get_credit(self):
+        return self._event_queue.credit()
+
+    def counters(self):
+        return self._event_queue.counters()
+
+    def enable_cpu_stats(self):
+        self._cpu.enable()
+
+    def get_pool(self):
+        return [self._thread]
+
+    def runtime_info(self):
+        info = queue_runtime_info(self._event_queue)
+        info['concurrency'] = self._concurrency
+        info['inflight'] = self._inflight_count
+        info['latency'] = self._latency.dump()
+        if self._cpu.enabled:
+            info.update(self._cpu.dump())
+        return info
+
+    def input(self, event, ctx=None):
+        if not self._event_queue.put((event, ctx)):
+            return False
+        # loop 已经被唤醒且尚未开始取数据时, 不需要再次唤醒
+        if not self._wakeup_pending:
+            self._wakeup_pending = True
+            self._loop.call_soon_threadsafe(self._dispatch)
+        return True
+
+    def _dispatch(self):
+        # 以下均在 loop 线程中执行
+        self._wakeup_pending = False
+        while self._inflight_count < self._concurrency:
+            try:
+                event, ctx = self._event_queue.get_nowait()
+            except Queue.Empty:
+                break
+            if self._controller_filter_cb is not None and not self._controller_filter_cb(event, ctx):
+                if ctx is not None:
+                    self._controller_finish_cb(ctx)
+                continue
+            self._inflight_count += 1
+            self._loop.create_task(self._run(event, ctx))
+
+    def _run(self, event, ctx):
+        start = time.time()
+        prev = set_event_context(ctx)
+        try:
+            cpu = self._cpu.begin()
+            try:
+                result = self.processer.proc(event)
+            finally:
+                self._cpu.end(cpu)
+            set_event_context(prev)
+            if isinstance(result, types.GeneratorType):
+                yield self._trollius.From(self._step(result, ctx))
+            elif self._trollius.iscoroutine(result) or isinstance(result, self._trollius.Future):
+                yield self._trollius.From(result)
+        except:
+            print_traceback(logger)
+        finally:
+            set_event_context(prev)
+            self._latency.observe(time.time() - start)
+            self._inflight_count -= 1
+            if ctx is not None:
+                self._controller_finish_cb(ctx)
+            self._dispatch()
+
+    def _step(self, gen, ctx):
+        """
+        手动驱动 proc 返回的协程, 每次恢复执行前设置它自己的 ctx,
+        多个 proc 在同一个线程中交替执行时, emit 也能对应到各自的输入 Event
+        """
+        value, exc_info = None, None
+        while True:
+            prev = set_event_context(ctx)
+            cpu = self._cpu.begin()
+            try:
+                if exc_info is None:
+                    future = gen.send(value)
+                else:
+                    future = gen.throw(*exc_info)
+            except StopIteration:
+                return
+            finally:
+                self._cpu.end(cpu)
+                set_event_context(prev)
+            value, exc_info = None, None
+            try:
+                value = yield future
+            except Exception:
+                exc_info = sys.exc_info()
+
+    def loop_run(self):
+        self._trollius.set_event_loop(self._loop)
+        try:
+            self.processer.initialize()
+        except:
+            print_traceback(logger)
+        self._start_success.set()
+        self._loop.run_forever()
+        self.processer.finish()
+        self._loop.close()
+
+    def start(self):
+        logger.debug("  |- Start Proc Node %s" % self.name)
+        self._thread.start()
+        if not self._start_success.wait(10):
+            raise ProcThreadInitError("proc thread %s init timeout" % self.name)
+        logger.debug("  |  |- Start Proc Unit %s id:%s" % (self.name, id(self._thread)))
+
+    def stop(self):
+        logger.debug("  |- Stop Proc Node %s" % self.name)
+        while True:
+            logger.info("%s _wait_for_all_msg_finish, unfinished: %s" % (self.name, self.get_event_pending_count()))
+            time.sleep(self._poll_timeout)
+            if 0 == self.get_event_pending_count():
+                break
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._event_queue.close()
+        logger.debug("  |  |- Stop Proc Unit %s id:%s" % (self.name, id(self._thread)))
+
+
+def create_filter(rules):
+    ruler = Ruler()
+    ruler.register_action('CONTINUE', 0)
+    ruler.register_action('ACCEPT', 1)
+    ruler.register_action('DROP', -1)
+    ruler.register_rule_set('local', rules)
+    return ruler
 
 
 class ProcNodeController:
 
-    def __init__(self, name, node_cls, node_args, pool_size=1, poll_timeout=1, queue_size=10000, mode='single', filter=None):
+    def __init__(self, name, node_cls, node_args, pool_size=1, poll_timeout=1, queue_size=10000, mode='single', filter=None,
+                 transport=None, batch_size=None, batch_linger_ms=0, overflow='drop_newest', block_timeout=1,
+                 spill_path=None, concurrency=100, partition_by=None, ordered=False, reorder_size=10000,
+                 filter_in_worker=False, output_lane=False, min_pool=None, max_pool=None, scale_interval=1,
+                 stats_window=10):
         # arguement check
         if not (issubclass(node_cls, OutputProcessNode) or issubclass(node_cls, HandlerProcessNode)):
             raise UnknownNodeType
 
-        self.filter = Ruler()
-        self.filter.register_action('CONTINUE', 0)
-        self.filter.register_action('ACCEPT', 1)
-        self.filter.register_action('DROP', -1)
-        _filter = filter if type(filter) == list else []
-        self.filter.register_rule_set('local', _filter)
+        self._filter_rules = filter if type(filter) == list else []
+        self._has_filter = len(self._filter_rules) > 0
+        # 启动前构建一次, 规则有误时尽早报错; Ruler 每次求值使用各自的变量栈, 可以被上游多个线程同时调用
+        self.filter = create_filter(self._filter_rules)
 
         # basic arguement
         self.name = name
         self._emit = None
-        self._emit_lock = threading.Lock()
+        self._emit_fused = False
+        self._credit = None
+        self._join = None
         self._poll_timeout = poll_timeout
         self._is_output = True if issubclass(node_cls, OutputProcessNode) else False
-
-        self._recv_count = 0
-        self._emit_count = 0
-        self._drop_count = 0
+        self._transport = transport if transport else Transport()
+
+        self._recv_count = Counter()
+        self._emit_count = Counter()
+        self._drop_count = Counter()
+        # 端到端延迟采样, 由 register_latency 开启
+        self._trace = False
+        self._residence = None
+        self._end_to_end = None
+        if self._is_output and mode == 'single' and output_lane:
+            # 开启 output_lane 的 single 模式 output 节点在独立的通道中处理, 不阻塞 handler 链
+            mode = 'lane'
         self._mode = mode
 
+        # filter_in_worker: 在本节点的 worker 取出 Event 后再执行 Filter, 不占用上游节点的线程
+        # output 节点收到 Event 后立即向下游发送, single 模式没有 worker, 二者都只能在调用者线程中执行
+        self._filter_in_worker = False
+        if filter_in_worker and self._has_filter:
+            if mode == 'single' or self._is_output:
+                logger.warning("%s is %s, ignore filter_in_worker" % (name, 'output node' if self._is_output else 'single'))
+            else:
+                self._filter_in_worker = True
+
+        # 有序模式只对使用 worker 并行处理的 handler 节点有意义
+        self._reorder = None
+        if ordered and mode != 'single' and not self._is_output:
+            self._reorder = ReorderBuffer(self.forward_ordered, reorder_size)
+
         node_mode_set = {
             'single': (ProcessNodeCoroutine, 1),
+            'lane': (ProcessNodeOutputLane, pool_size),
             'thread': (ProcessNodeThread, pool_size),
-            'process': (None, pool_size)
+            'process': (ProcessNodeProcess, pool_size),
+            'async': (ProcessNodeAsync, concurrency)
         }
         if mode not in node_mode_set:
             raise Exception("Node mode %s doesn't exist!" % mode)
+        if (min_pool or max_pool) and mode not in ('thread', 'lane'):
+            logger.warning("%s is %s, ignore min_pool/max_pool" % (name, mode))
 
         proc_node_cls, pool_size = node_mode_set.get(mode)
         self.node = proc_node_cls(name, node_cls, node_args, self.controller_emit_callback,
-                                  poll_timeout=poll_timeout, pool_size=pool_size, queue_size=queue_size)
-
-    def register_emit(self, emit):
+                                  poll_timeout=poll_timeout, pool_size=pool_size, queue_size=queue_size,
+                                  batch_size=batch_size, batch_linger=batch_linger_ms / 1000.0,
+                                  overflow=overflow, block_timeout=block_timeout, spill_path=spill_path,
+                                  partition_by=partition_by, controller_finish_cb=self.controller_finish_callback,
+                                  ordered=self._reorder is not None,
+                                  controller_filter_cb=self.worker_filter_callback if self._filter_in_worker else None,
+                                  min_pool=min_pool, max_pool=max_pool, scale_interval=scale_interval,
+                                  stats_window=stats_window)
+
+    def register_emit(self, emit, fused=False):
+        """
+        fused: 下一个节点与本节点融合为一条直接调用链, emit 为下一个节点的 fused_input,
+               发送时不再做序列化
+        """
         self._emit = emit
+        self._emit_fused = fused
+
+    def register_join(self, join):
+        """ 作为 DAG 中的 merge 节点, 上游各分支的 Event 先经 join 汇合 """
+        self._join = join
+
+    def register_latency(self, end_to_end=None):
+        """
+        开启采样 Event 的延迟统计: 本节点的驻留时间(从收到 Event 到处理完成, 包括排队等待与 proc),
+        end_to_end 为 Stream 的端到端延迟直方图, 没有下游的节点处理完采样的 Event 时记录, 需在 register_emit 之后调用
+        """
+        self._trace = True
+        self._residence = HdrHistogram()
+        self._end_to_end = end_to_end if self._emit is None else None
+
+    def register_cpu_stats(self):
+        """ 开启节点的 CPU 时间统计, 每个 Event(batch) 处理前后各读取一次线程 CPU 时钟 """
+        self.node.enable_cpu_stats()
+
+    def is_single(self):
+        return self._mode == 'single'
+
+    def register_credit(self, credit):
+        self._credit = credit
+
+    def credit(self):
+        """
+        本节点及下游所有节点中最少的剩余可接收 Event 数, None 表示不限制。
+        Trigger 通过第一个节点的 credit 得知下游是否已饱和, 从而暂停拉取数据。
+        """
+        credit = self.node.get_credit()
+        if self._credit:
+            downstream = self._credit()
+            if credit is None or (downstream is not None and downstream < credit):
+                credit = downstream
+        return credit
 
     def controller_emit_callback(self, event):
-        self._emit_count += 1
-        if self._emit:
-            # node间数据json格式流转。发送Event前先反序列化
-            event = ujson.dumps(event)
-            if self._emit_lock.acquire():
-                self._emit(event)
-            self._emit_lock.release()
-        else:
-            logger.debug("%s next emit is None, Finished Process" % self.name)
-            pass
-
-    def input(self, raw):
-        # node间数据json格式流转。使用收到Event时先反序列化
-        try:
-            event = ujson.loads(raw)
-        except TypeError as e:
-            logger.error("Process node json loads Error:%s" % str(e))
-            logger.error("raw is : \n%s" % raw)
-            return
-
-        self._recv_count += 1
-        # 检查Filter
+        # 由各个 worker 线程并发调用, 直接交给下游节点的 input (输入队列或 single 节点), 不持有锁
+        self._emit_count.add()
+        if self._reorder is not None:
+            ctx = get_event_context()
+            if ctx is not None and ctx.get('node') == self.name:
+                self._reorder.add(ctx['seq'], (event, ctx))
+                return
+        self.forward(event)
+
+    def controller_finish_callback(self, ctx):
+        # worker 处理完一个带 ctx 的 Event
+        if self._trace and 'ingest' in ctx:
+            now = time.time()
+            self._residence.observe(now - ctx['ts'])
+            if self._end_to_end is not None:
+                self._end_to_end.observe(now - ctx['ingest'])
+        if self._reorder is not None and 'seq' in ctx:
+            self._reorder.complete(ctx['seq'])
+
+    def worker_filter_callback(self, event, ctx):
+        """
+        filter_in_worker 时由本节点的 worker 在取出 Event 后调用, 返回 True 表示交给 proc 处理
+        CONTINUE/DROP 的语义与在调用者线程中执行时相同
+        """
+        filter_result, rule = self.filter_event(event)
+        if filter_result == 0:
+            if logger.debug_enabled():
+                logger.debug("%s's filter send event to next node! reason: '%s', raw:\n%s" % (self.name, rule, str(event)))
+            if self._reorder is not None and ctx is not None:
+                self._emit_count.add()
+                self._reorder.add(ctx['seq'], (event, ctx))
+            else:
+                # 在 Event 自己的 ctx 下发送, 采样信息随之传给下游
+                prev = set_event_context(ctx)
+                try:
+                    self.controller_emit_callback(event)
+                finally:
+                    set_event_context(prev)
+            return False
+        elif filter_result == -1:
+            if logger.debug_enabled():
+                logger.debug("%s's filter drop event! reason: '%s', raw:\n%s" % (self.name, rule, str(event)))
+            self._drop_count.add()
+            return False
+        elif filter_result == 1 or filter_result is None:
+            if logger.debug_enabled():
+                logger.debug("%s's filter accept event! reason: '%s', raw:\n%s" % (self.name, rule, str(event)))
+            return True
+        logger.error("%s's Filter Error: error filter result %s" % (self.name, filter_result))
+        return False
+
+    def filter_event(self, event):
+        """ 执行 Filter, 返回 (动作, 规则) """
         try:
             filter_result = self.filter.entry('local', event)
         except RulerNoMatch:
@@ -286,28 +1257,122 @@ class ProcNodeController:
             logger.error("%s's Filter Error:%s !" % (self.name, str(e)))
             filter_result = -1, "Filter Error:%s" % str(e)
 
-        (filter_result, rule) = (filter_result[0], filter_result[1]) if filter_result else (None, 'no rule match')
+        return (filter_result[0], filter_result[1]) if filter_result else (None, 'no rule match')
+
+    def forward(self, event):
+        if self._emit_fused:
+            self._emit(self._transport.protect(event))
+        elif self._emit:
+            # json模式下发送Event前先序列化; object模式下按event_guard保护后直接传递对象
+            self._emit(self._transport.pack(event))
+        elif logger.debug_enabled():
+            logger.debug("%s next emit is None, Finished Process" % self.name)
+
+    def forward_ordered(self, item):
+        # 按顺序释放的 Event 在其输入 Event 的 ctx 下发送, 采样信息随之传给下游
+        event, ctx = item
+        if 'ingest' not in ctx:
+            self.forward(event)
+            return
+        prev = set_event_context(ctx)
+        try:
+            self.forward(event)
+        finally:
+            set_event_context(prev)
+
+    def input(self, raw):
+        # json模式下收到Event时先反序列化, object模式下直接使用
+        try:
+            event = self._transport.unpack(raw)
+        except TypeError as e:
+            logger.error("Process node json loads Error:%s" % str(e))
+            logger.error("raw is : \n%s" % raw)
+            return
+        self.fused_input(event)
+
+    def fused_input(self, event):
+        """ 融合调用链中上一个节点直接调用, event 已经是对象, 无需反序列化 """
+        self._recv_count.add()
+        seq = self._reorder.stamp() if self._reorder is not None else None
+        # 上游(Trigger 或上一个节点的 proc)正在处理的是被采样的 Event 时, 为本节点的处理生成新的 ctx
+        trace = None
+        if self._trace:
+            upstream = get_event_context()
+            if upstream is not None and 'ingest' in upstream:
+                trace = {'ingest': upstream['ingest'], 'ts': time.time()}
+        # 检查Filter, 没有配置Filter时不会有任何规则匹配, 直接跳过; filter_in_worker 时交给 worker 执行
+        if not self._has_filter or self._filter_in_worker:
+            filter_result, rule = None, 'no rule match'
+        else:
+            filter_result, rule = self.filter_event(event)
 
         if filter_result == 0:  # CONTINUE: 匹配中 CONTINUE  直接发送至下一个节点
-            self.controller_emit_callback(event)
-            logger.debug("%s's filter send event to next node! reason: '%s', raw:\n%s" % (self.name, rule, str(raw)))
+            if seq is not None:
+                self._emit_count.add()
+                self._reorder.add(seq, (event, trace if trace is not None else {}))
+                self._reorder.complete(seq)
+            else:
+                self.controller_emit_callback(event)
+            if logger.debug_enabled():
+                logger.debug("%s's filter send event to next node! reason: '%s', raw:\n%s" % (self.name, rule, str(event)))
         elif filter_result == -1:  # DROP: 匹配中 Drop 丢弃该event
-            self._drop_count += 1
-            logger.debug("%s's filter drop event! reason: '%s', raw:\n%s" % (self.name, rule, str(raw)))
+            self._drop_count.add()
+            if seq is not None:
+                self._reorder.complete(seq)
+            if logger.debug_enabled():
+                logger.debug("%s's filter drop event! reason: '%s', raw:\n%s" % (self.name, rule, str(event)))
         elif filter_result == 1 or filter_result is None:  # ACCEPT: 匹配中 ACCEPT 或未匹配中 接受 Event
-            logger.debug("%s's filter accept event! reason: '%s', raw:\n%s" % (self.name, rule, str(raw)))
-            self.node.input(event)
+            if logger.debug_enabled():
+                logger.debug("%s's filter accept event! reason: '%s', raw:\n%s" % (self.name, rule, str(event)))
             if self._is_output:  # 如果是输出节点，直接返回将Event返回
+                self.node.input(self._transport.fork(event), trace)
                 self.controller_emit_callback(event)
-            pass
+            elif seq is not None:
+                ctx = {'node': self.name, 'seq': seq}
+                if trace is not None:
+                    ctx.update(trace)
+                if not self.node.input(event, ctx):
+                    # 被输入队列丢弃的 Event 不会再有 worker 处理, 直接标记完成
+                    self._reorder.complete(seq)
+            else:
+                self.node.input(event, trace)
         else:
+            if seq is not None:
+                self._reorder.complete(seq)
             raise Exception("Error filter result %s" % filter_result)
 
     def start(self):
         self.node.start()
+        if self._join is not None:
+            self._join.start()
 
     def stop(self):
+        if self._join is not None:
+            self._join.stop()
         self.node.stop()
 
+    def counters(self):
+        """ runtime info 中由 Counter 原地更新的字段 """
+        counters = OrderedDict([('recv', self._recv_count), ('emit', self._emit_count), ('drop', self._drop_count)])
+        counters.update(self.node.counters())
+        return counters
+
     def runtime_info(self):
-        return self._recv_count, self._emit_count, self._drop_count, self._mode, self.node.get_event_pending_count()
+        info = OrderedDict()
+        info['recv'] = self._recv_count.value
+        info['emit'] = self._emit_count.value
+        info['drop'] = self._drop_count.value
+        info['mode'] = self._mode
+        if self._emit_fused:
+            info['fused'] = True
+        info['pending'] = self.node.get_event_pending_count()
+        info.update(self.node.runtime_info())
+        if self._residence is not None:
+            info['residence'] = self._residence.dump()
+        if self._reorder is not None:
+            info['reorder'] = self._reorder.runtime_info()
+        if self._join is not None:
+            info['join'] = self._join.runtime_info()
+        if isinstance(self._emit, FanOut):
+            info['edges'] = self._emit.runtime_info()
+        return info
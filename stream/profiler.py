@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# standard library modules
+import os
+import sys
+import time
+import signal
+import threading
+from collections import defaultdict
+
+import logger
+
+
+class StackProfiler:
+    """
+    采样式 profiler: 以 hz 的频率对进程中所有线程的调用栈采样, 持续 duration 秒后把结果以 collapsed stack 格式
+    写入 path 目录下的 <name>.<时间>.collapsed, 每行为 "线程名;最外层函数;...;最内层函数 采样次数",
+    可以直接交给 flamegraph.pl 或 speedscope 生成火焰图。线程名即节点的 worker 名(<Stream>.<Node>-unit.N[t] 等)。
+    采样的是墙上时间, 阻塞等待中的线程也会被记录(栈顶为 wait/get 等)。
+    只有 start 之后才会启动采样线程, 平时没有任何开销。
+    信号处理函数中只调用 request 设置标记, 由主循环调用 poll 启动采样: 信号可能在主线程持有日志等锁时到达,
+    在信号处理函数中加锁或写日志会死锁。
+    """
+
+    def __init__(self, name, path, hz=100, duration=30):
+        self.name = name
+        self._path = path
+        self._interval = 1.0 / hz
+        self._duration = duration
+        self._lock = threading.Lock()
+        self._thread = None
+        self._labels = {}
+        self._requested = False
+
+    def request(self):
+        self._requested = True
+
+    def poll(self):
+        """ 有 request 时开始采样 """
+        if self._requested:
+            self._requested = False
+            self.start()
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._lock:
+            if self.is_running():
+                logger.warning("%s profiler is already running" % self.name)
+                return False
+            self._thread = threading.Thread(target=self.run, name=self.name + "-profiler")
+            self._thread.daemon = True
+            self._thread.start()
+        return True
+
+    def run(self):
+        logger.info("%s profiler start, %s samples/s for %ss" % (self.name, int(1 / self._interval), self._duration))
+        counts = defaultdict(int)
+        samples = 0
+        me = threading.current_thread().ident
+        deadline = time.time() + self._duration
+        while time.time() < deadline:
+            self.sample(counts, me)
+            samples += 1
+            time.sleep(self._interval)
+        path = self.write(counts)
+        logger.info("%s profiler finish, %s samples written to %s" % (self.name, samples, path))
+
+    def label(self, code):
+        label = self._labels.get(code, None)
+        if label is None:
+            label = "%s (%s:%s)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+            label = self._labels[code] = label.replace(';', ':')
+        return label
+
+    def sample(self, counts, me):
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            # fork 出的进程中还残留着父进程其他线程的状态, 只采样当前存活的线程
+            if ident == me or ident not in names:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self.label(frame.f_code))
+                frame = frame.f_back
+            stack.append(names[ident].replace(';', ':').replace(' ', '_'))
+            counts[';'.join(reversed(stack))] += 1
+
+    def write(self, counts):
+        path = os.path.join(self._path, "%s.%s.collapsed" % (self.name, time.strftime("%Y%m%d-%H%M%S")))
+        with open(path, 'w') as f:
+            for stack, count in sorted(counts.items()):
+                f.write("%s %s\n" % (stack, count))
+        return path
+
+
+def install_profiler(name, conf):
+    """
+    Stream 进程收到 SIGUSR1 时开始采样, conf 为 Stream 配置中的 profile: {"hz": 100, "duration": 30}
+    采样在调用者的主循环下一次调用 poll 时开始, 采样进行中再次收到信号时忽略
+    """
+    profiler = StackProfiler(name, logger.g_logger_path, hz=conf.get('hz', 100), duration=conf.get('duration', 30))
+
+    def sig_handler(signum, frame):
+        profiler.request()
+
+    signal.signal(signal.SIGUSR1, sig_handler)
+    return profiler
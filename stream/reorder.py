@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+# standard library modules
+import time
+import threading
+from collections import deque, OrderedDict
+
+from utils import print_traceback
+
+import logger
+
+
+class ReorderBuffer:
+    """
+    ordered 节点的重排序缓冲区
+    节点在 input 时为每个 Event 分配递增的序号(stamp), worker 处理过程中 emit 的 Event 按序号暂存(add),
+    worker 处理完一个 Event 后标记该序号完成(complete)。只有当前最小的未释放序号完成时, 才按序号顺序
+    把暂存的 Event 交给 emit, 所以下游看到的顺序与节点收到 Event 的顺序一致。
+    缓冲区中未释放的序号达到 size 时, stamp 会阻塞上游, 直到队首的 Event 处理完成。
+    """
+
+    def __init__(self, emit, size=10000):
+        self._emit = emit
+        self._size = size
+        self._cond = threading.Condition()
+        self._next_seq = 0
+        self._head = 0
+        self._outputs = {}
+        self._done = {}
+        self._ready = deque()
+        self._releasing = False
+
+        self.max_depth = 0
+        self.blocked_time = 0.0
+        self.hol_wait_time = 0.0
+        self.hol_wait_max = 0.0
+
+    def depth(self):
+        return self._next_seq - self._head
+
+    def stamp(self):
+        with self._cond:
+            if self._next_seq - self._head >= self._size:
+                start = time.time()
+                while self._next_seq - self._head >= self._size:
+                    self._cond.wait(1)
+                self.blocked_time += time.time() - start
+            seq = self._next_seq
+            self._next_seq += 1
+            depth = self._next_seq - self._head
+            if depth > self.max_depth:
+                self.max_depth = depth
+            return seq
+
+    def add(self, seq, event):
+        with self._cond:
+            self._outputs.setdefault(seq, []).append(event)
+
+    def complete(self, seq):
+        with self._cond:
+            self._done[seq] = time.time()
+            if seq != self._head:
+                return
+            now = time.time()
+            while self._head in self._done:
+                # 队首阻塞时间: 该序号完成后, 因为前面的序号尚未完成而等待的时间
+                wait = now - self._done.pop(self._head)
+                self.hol_wait_time += wait
+                if wait > self.hol_wait_max:
+                    self.hol_wait_max = wait
+                self._ready.extend(self._outputs.pop(self._head, ()))
+                self._head += 1
+            self._cond.notify_all()
+            if self._releasing:
+                # 已经有线程在按顺序释放, 交给它处理
+                return
+            self._releasing = True
+
+        # 释放时不持有锁, 同一时刻只有一个线程在释放, 保证顺序
+        while True:
+            with self._cond:
+                if not self._ready:
+                    self._releasing = False
+                    return
+                events = list(self._ready)
+                self._ready.clear()
+            for event in events:
+                try:
+                    self._emit(event)
+                except:
+                    print_traceback(logger)
+
+    def runtime_info(self):
+        info = OrderedDict()
+        info['depth'] = self.depth()
+        info['max_depth'] = self.max_depth
+        info['blocked'] = round(self.blocked_time, 3)
+        info['hol_wait'] = round(self.hol_wait_time, 3)
+        info['hol_wait_max'] = round(self.hol_wait_max, 3)
+        return info
@@ -71,6 +71,12 @@ class Server(object):
         signal.signal(signal.SIGQUIT, sig_handler)
         signal.signal(signal.SIGTERM, sig_handler)
 
+        # SIGUSR1: 由主循环转发给所有 Stream 进程, 各自采样调用栈; 信号处理函数中不能写日志, 只设置标记
+        def profile_handler(signum, frame):
+            self.stream_ctrl.request_profile()
+
+        signal.signal(signal.SIGUSR1, profile_handler)
+
     def run(self):
         logger.init()
         self.init_signal_handler(logger)
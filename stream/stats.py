@@ -0,0 +1,539 @@
+# -*- coding: utf-8 -*-
+
+# standard library modules
+import os
+import math
+import mmap
+import json
+import struct
+import ctypes
+import ctypes.util
+import bisect
+import time
+import threading
+from collections import OrderedDict
+
+
+class Counter:
+    """
+    线程安全的计数器
+    多个 worker 线程并发 emit 时, `count += 1` 不是原子操作, 会丢失计数;
+    这里只在更新计数时短暂持有锁, 不会把下游节点的处理串行化。
+    绑定到 StatsSegment 的槽位后, 每次更新同时写入共享内存。
+    """
+
+    def __init__(self, value=0):
+        self._value = value
+        self._lock = threading.Lock()
+        self._slots = None
+        self._slot = None
+
+    def add(self, n=1):
+        with self._lock:
+            self._value += n
+            if self._slots is not None:
+                self._slots[self._slot] = self._value
+
+    def bind(self, slots, slot):
+        with self._lock:
+            self._slots = slots
+            self._slot = slot
+            slots[slot] = self._value
+
+    @property
+    def value(self):
+        return self._value
+
+
+class Histogram:
+    """
+    固定分桶的直方图(单位: 秒), 记录一次只需一次二分查找和一次加锁的计数
+    dump 的 buckets 与 Prometheus 一致, 为 <= 上界的累计次数
+    """
+
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, buckets=None):
+        self._buckets = tuple(buckets) if buckets else self.default_buckets
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def dump(self):
+        info = OrderedDict()
+        buckets = OrderedDict()
+        total = 0
+        for bucket, count in zip(self._buckets, self._counts):
+            total += count
+            buckets[str(bucket)] = total
+        total += self._counts[-1]
+        buckets['+Inf'] = total
+        info['buckets'] = buckets
+        info['sum'] = round(self._sum, 6)
+        info['count'] = total
+        return info
+
+    @classmethod
+    def from_hdr(cls, hdrs, buckets=None):
+        """
+        由 HdrHistogram 的计数换算出固定分桶的直方图, 包含上界的 HdrHistogram 桶计入该上界, 有 1/64 的相对误差
+        按上界对应的下标对计数数组分段求和, 不逐个遍历 HdrHistogram 的桶
+        """
+        hist = cls(buckets)
+        for hdr in hdrs:
+            for i, count in enumerate(hdr.bucket_counts(hist._buckets)):
+                hist._counts[i] += count
+            hist._sum += hdr.sum
+        return hist
+
+
+class HdrHistogram:
+    """
+    HDR 风格的对数-线性分桶直方图, 用于计算延迟的分位数(单位: 秒, 内部按微秒取整)
+    小于 128us 的值每微秒一个桶, 之后每个 2 的幂区间等分为 64 个子桶, 相对误差不超过 1/64;
+    桶的数量只由 max_value 决定, 记录一次只需几次整数运算和一次加锁的计数。
+    """
+
+    sub_bits = 6
+
+    def __init__(self, max_value=3600):
+        self._max_value = int(max_value * 1000000)
+        self._counts = [0] * (self.index(self._max_value) + 1)
+        self._total = 0
+        self._sum = 0.0
+        self._max = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def index(cls, value):
+        # value < 128 时下标即为值本身; 否则保留最高的 7 位, shift 为舍去的位数
+        shift = value.bit_length() - cls.sub_bits - 1
+        if shift <= 0:
+            return value
+        return (shift << cls.sub_bits) + (value >> shift)
+
+    @classmethod
+    def highest_value(cls, index):
+        """ 下标对应的桶中最大的值 """
+        shift = max(index >> cls.sub_bits, 1) - 1
+        return ((index - (shift << cls.sub_bits) + 1) << shift) - 1
+
+    def observe(self, seconds):
+        value = min(max(int(seconds * 1000000), 0), self._max_value)
+        i = self.index(value)
+        with self._lock:
+            self._counts[i] += 1
+            self._total += 1
+            self._sum += seconds
+            if value > self._max:
+                self._max = value
+
+    def merge(self, other):
+        """ 把 other 的计数累加进来, other 需与自身的 max_value 相同 """
+        with self._lock:
+            for i, c in enumerate(other._counts):
+                if c:
+                    self._counts[i] += c
+            self._total += other._total
+            self._sum += other._sum
+            self._max = max(self._max, other._max)
+
+    @property
+    def count(self):
+        return self._total
+
+    @property
+    def sum(self):
+        return self._sum
+
+    def bucket_counts(self, bounds):
+        """ 落在各上界(秒, 升序)区间内的次数, 最后一项为大于最大上界的次数 """
+        counts = self._counts
+        result = []
+        start = 0
+        for bound in bounds:
+            end = self.index(min(int(bound * 1000000), self._max_value)) + 1
+            result.append(sum(counts[start:end]))
+            start = end
+        result.append(sum(counts[start:]))
+        return result
+
+    def percentiles(self, quantiles):
+        """ 返回各分位数对应的值(秒), 没有记录时均为 0 """
+        total = self._total
+        if total == 0:
+            return [0.0] * len(quantiles)
+        targets = [max(int(math.ceil(q * total)), 1) for q in quantiles]
+        values = [None] * len(quantiles)
+        count = 0
+        for i, c in enumerate(self._counts):
+            if not c:
+                continue
+            count += c
+            for j, target in enumerate(targets):
+                if values[j] is None and count >= target:
+                    values[j] = min(self.highest_value(i), self._max) / 1000000.0
+            if values[-1] is not None:
+                break
+        return [v if v is not None else self._max / 1000000.0 for v in values]
+
+    def dump(self):
+        info = OrderedDict()
+        info['count'] = self._total
+        info['sum'] = round(self._sum, 6)
+        p50, p99, p999 = self.percentiles((0.5, 0.99, 0.999))
+        info['p50'] = round(p50, 6)
+        info['p99'] = round(p99, 6)
+        info['p999'] = round(p999, 6)
+        info['max'] = round(self._max / 1000000.0, 6)
+        return info
+
+
+class WindowHistogram:
+    """
+    按 window 秒为周期重置的 HdrHistogram, dump 返回上一个完整周期的分布, 反映近期而不是启动以来的情况
+    结束的周期累加到 _total 中, dump_total 由此换算出启动以来的固定分桶直方图, 同一个耗时不必再单独记录一次
+    周期在 dump 时切换, 切换时正在记录的少量数据可能计入上一个周期或丢失
+    """
+
+    def __init__(self, window=10):
+        self._window = window
+        self._current = HdrHistogram()
+        self._total = HdrHistogram()
+        self._last = self._current.dump()
+        self._start = time.time()
+
+    def observe(self, seconds):
+        self._current.observe(seconds)
+
+    def dump(self):
+        now = time.time()
+        if now - self._start >= self._window:
+            current, self._current = self._current, HdrHistogram()
+            self._total.merge(current)
+            self._last = current.dump()
+            self._start = now
+        # 分位数与 count/sum 为上一个周期的, total_count/total_sum 为启动以来的累计值
+        info = OrderedDict(self._last)
+        info['total_count'] = self._total.count + self._current.count
+        info['total_sum'] = round(self._total.sum + self._current.sum, 6)
+        return info
+
+    def dump_total(self, buckets=None):
+        """ 启动以来的分布, 格式与 Histogram.dump 相同 """
+        return Histogram.from_hdr((self._total, self._current), buckets).dump()
+
+
+CLOCK_THREAD_CPUTIME_ID = 3
+
+
+def load_thread_cpu_clock():
+    """
+    返回读取当前线程 CPU 时间(秒)的函数, 平台不支持时返回 None
+    python2 没有 time.clock_gettime, 这里通过 ctypes 调用 clock_gettime(CLOCK_THREAD_CPUTIME_ID)
+    """
+    clock_gettime = None
+    for name in ('rt', 'c'):
+        path = ctypes.util.find_library(name)
+        try:
+            clock_gettime = ctypes.CDLL(path).clock_gettime
+            break
+        except (OSError, AttributeError):
+            continue
+    if clock_gettime is None:
+        return None
+    # struct timespec { long tv_sec; long tv_nsec; }
+    timespec = ctypes.c_long * 2
+    if clock_gettime(CLOCK_THREAD_CPUTIME_ID, timespec()) != 0:
+        return None
+
+    def thread_cpu_time():
+        ts = timespec()
+        clock_gettime(CLOCK_THREAD_CPUTIME_ID, ts)
+        return ts[0] + ts[1] * 1e-9
+
+    return thread_cpu_time
+
+
+thread_cpu_time = load_thread_cpu_clock()
+
+
+def process_cpu_time(pid):
+    """ 进程的 CPU 时间(秒, user + system), 从 /proc 读取, 进程不存在或平台不支持时返回 None """
+    try:
+        with open('/proc/%s/stat' % pid) as f:
+            stat = f.read()
+    except IOError:
+        return None
+    # 进程名中可能有空格, 从最后一个 ')' 之后开始数: utime/stime 为第 14/15 个字段
+    fields = stat.rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(os.sysconf('SC_CLK_TCK'))
+
+
+# 当前线程中正在统计的 CPU 时间里, 嵌套调用的下游节点已经记录的部分
+_cpu_nested = threading.local()
+
+
+class CpuUsage:
+    """
+    节点占用的 CPU 时间, 按线程 CPU 时钟在调用节点的前后(begin/end)统计, 同一进程中的其他线程不影响结果。
+    节点 emit 时下游的 single 节点在同一个线程中被直接调用, begin/end 可以嵌套, 下游节点的 CPU 时间只记在下游节点上。
+    dump 中 cpu 为累计的秒数, cpu_util 为最近至少 window 秒内的利用率, 1.0 表示占满一个 CPU 核心。
+    每次 begin/end 各读取一次线程 CPU 时钟, 默认关闭, 由 enable 开启。
+    """
+
+    available = thread_cpu_time is not None
+
+    def __init__(self, window=1):
+        self.enabled = False
+        self._time = Counter(0.0)
+        self._window = window
+        self._last = None
+        self._util = 0.0
+
+    def enable(self):
+        self.enabled = self.available
+
+    def begin(self):
+        if not self.enabled:
+            return None
+        nested = getattr(_cpu_nested, 'time', 0.0)
+        _cpu_nested.time = 0.0
+        return thread_cpu_time(), nested
+
+    def end(self, token):
+        if token is None:
+            return
+        start, nested = token
+        used = thread_cpu_time() - start
+        self._time.add(used - _cpu_nested.time)
+        _cpu_nested.time = nested + used
+
+    def add(self, seconds):
+        self._time.add(seconds)
+
+    @property
+    def value(self):
+        return self._time.value
+
+    def dump(self, total=None):
+        total = self._time.value if total is None else total
+        now = time.time()
+        if self._last is None:
+            self._last = (now, total)
+        elif now - self._last[0] >= self._window:
+            self._util = (total - self._last[1]) / (now - self._last[0])
+            self._last = (now, total)
+        info = OrderedDict()
+        info['cpu'] = round(total, 3)
+        info['cpu_util'] = round(self._util, 3)
+        return info
+
+
+class StatsSegmentFull(Exception):
+    pass
+
+
+class StatsSegment:
+    """
+    Stream 进程的 runtime info 共享内存段
+    在父进程 fork Stream 进程之前创建(匿名 mmap, 父子进程共享同一块内存), Stream 进程写, 父进程随时读,
+    不需要 IPC, 也不需要序列化。
+    布局:
+        header  magic | version | layout 编号 | layout 长度 | strings 长度
+        layout  json, runtime info 中每个叶子节点一项: [路径, 槽位, 类型] 数值型, 值在 slots 中原地更新
+                                                      [路径, null]        字符串等其他类型, 值在 strings 中
+        strings json, 非数值叶子节点的值, 按 layout 中的顺序排列
+        slots   double 数组
+    runtime info 的结构变化时(例如出现新的字段)重写 layout, 只有字符串等值变化时(例如 last_scale)只重写 strings,
+    version 为奇数表示正在重写。
+    共享内存在 fork 之前分配, 之后无法扩大, 大小由 Stream 的节点数决定(见 Stream), strings 段为 layout 段的 1/4。
+    """
+
+    magic = 'PSSTATS2'
+    header = struct.Struct('8sQQII')
+
+    def __init__(self, layout_size=65536, slot_count=8192):
+        self._layout_offset = self.header.size
+        self._layout_size = layout_size
+        self._strings_offset = self._layout_offset + layout_size
+        self._strings_size = layout_size // 4
+        self._slot_offset = (self._strings_offset + self._strings_size + 7) // 8 * 8
+        self._slot_count = slot_count
+        self._mm = mmap.mmap(-1, self._slot_offset + slot_count * 8)
+        self._slots = (ctypes.c_double * slot_count).from_buffer(self._mm, self._slot_offset)
+        self.header.pack_into(self._mm, 0, self.magic, 0, 0, 0, 0)
+
+        # 写端
+        self._version = 0
+        self._layout_id = 0
+        self._layout_length = 0
+        self._signature = None
+        self._strings = None
+        self._leaves = []
+        self._bound = set()
+        # 读端, 心跳与 HTTP 请求等多个线程会同时读取: (version, layout 编号, layout, strings) 整体替换, 不需要加锁
+        self._read_cache = (None, None, None, None)
+
+    def version(self):
+        return self.header.unpack_from(self._mm, 0)[1]
+
+    def publish(self, info, counters=None):
+        """
+        写入 runtime info, counters 为 {路径: Counter}, 对应的槽位绑定到 Counter 由其原地更新
+        """
+        leaves = flatten(info)
+        signature = [(path, number_type(value) if is_number(value) else None) for path, value in leaves]
+        strings = [value for path, value in leaves if not is_number(value)]
+        if signature != self._signature:
+            self.write_layout(leaves, strings, counters if counters else {})
+            self._signature = signature
+        elif strings != self._strings:
+            self.write_strings(strings)
+        for (path, value), slot in zip(leaves, self._leaves):
+            if slot is not None and slot not in self._bound:
+                self._slots[slot] = value
+
+    def _begin_write(self):
+        self._version += 1
+        self.header.pack_into(self._mm, 0, self.magic, self._version, self._layout_id, self._layout_length, 0)
+
+    def _end_write(self, strings_length):
+        self._version += 1
+        self.header.pack_into(self._mm, 0, self.magic, self._version, self._layout_id, self._layout_length,
+                              strings_length)
+
+    def _dump_strings(self, strings):
+        raw = json.dumps(strings)
+        if len(raw) > self._strings_size:
+            raise StatsSegmentFull("runtime info strings has %s bytes, segment has %s bytes"
+                                   % (len(raw), self._strings_size))
+        return raw
+
+    def write_strings(self, strings):
+        raw = self._dump_strings(strings)
+        self._begin_write()
+        self._mm[self._strings_offset:self._strings_offset + len(raw)] = raw
+        self._end_write(len(raw))
+        self._strings = strings
+
+    def write_layout(self, leaves, strings, counters):
+        layout = []
+        slots = []
+        slot = 0
+        for path, value in leaves:
+            if is_number(value):
+                layout.append([path, slot, number_type(value)])
+                slots.append(slot)
+                slot += 1
+            else:
+                layout.append([path, None])
+                slots.append(None)
+        raw = json.dumps(layout)
+        if len(raw) > self._layout_size or slot > self._slot_count:
+            raise StatsSegmentFull("runtime info has %s fields (%s bytes layout), segment has %s slots (%s bytes)"
+                                   % (slot, len(raw), self._slot_count, self._layout_size))
+        strings_raw = self._dump_strings(strings)
+
+        self._begin_write()
+        self._mm[self._layout_offset:self._layout_offset + len(raw)] = raw
+        self._mm[self._strings_offset:self._strings_offset + len(strings_raw)] = strings_raw
+        self._layout_id += 1
+        self._layout_length = len(raw)
+        self._bound = set()
+        for (path, value), slot in zip(leaves, slots):
+            if slot is None:
+                continue
+            counter = counters.get(tuple(path), None)
+            if counter is not None:
+                counter.bind(self._slots, slot)
+                self._bound.add(slot)
+            else:
+                self._slots[slot] = value
+        self._leaves = slots
+        self._strings = strings
+        self._end_write(len(strings_raw))
+
+    def read(self, retry=10):
+        """ 读取 runtime info, Stream 进程尚未写入时返回 None """
+        for _ in range(retry):
+            magic, version, layout_id, size, strings_size = self.header.unpack_from(self._mm, 0)
+            if version == 0:
+                return None
+            if version % 2:
+                continue
+            cache = self._read_cache
+            if version != cache[0]:
+                try:
+                    layout = cache[2]
+                    if layout_id != cache[1]:
+                        layout = json.loads(self._mm[self._layout_offset:self._layout_offset + size])
+                    strings = json.loads(self._mm[self._strings_offset:self._strings_offset + strings_size])
+                except ValueError:
+                    # 读取的过程中写端开始重写, 读到的 json 不完整
+                    if self.version() != version:
+                        continue
+                    raise
+                if self.version() != version:
+                    continue
+                cache = (version, layout_id, layout, strings)
+                self._read_cache = cache
+            return unflatten(cache[2], cache[3], self._slots)
+        return None
+
+
+def is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+
+def number_type(value):
+    return 'float' if isinstance(value, float) else 'int'
+
+
+def flatten(info, path=None):
+    """ 把 runtime info 展开为 [(路径, 值)], 路径中 int 为 list 的下标 """
+    path = path if path else []
+    leaves = []
+    if isinstance(info, dict) and info:
+        for k, v in info.iteritems():
+            leaves.extend(flatten(v, path + [k]))
+    elif isinstance(info, list) and info:
+        for i, v in enumerate(info):
+            leaves.extend(flatten(v, path + [i]))
+    else:
+        leaves.append((path, info))
+    return leaves
+
+
+def unflatten(layout, strings, slots):
+    info = OrderedDict()
+    strings = iter(strings)
+    for entry in layout:
+        path, slot = entry[0], entry[1]
+        if slot is None:
+            value = next(strings)
+        elif entry[2] == 'int':
+            value = int(slots[slot])
+        else:
+            value = slots[slot]
+        node = info
+        for k, next_k in zip(path[:-1], path[1:]):
+            if isinstance(node, list):
+                if k == len(node):
+                    node.append([] if isinstance(next_k, int) else OrderedDict())
+                node = node[k]
+            else:
+                if k not in node:
+                    node[k] = [] if isinstance(next_k, int) else OrderedDict()
+                node = node[k]
+        if isinstance(node, list):
+            node.append(value)
+        else:
+            node[path[-1]] = value
+    return info
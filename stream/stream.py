@@ -5,15 +5,17 @@
 
 import os
 import time
-import json
 import signal
 import threading
 import multiprocessing
 from collections import OrderedDict
-from Queue import Empty
 
 from process_node import ProcNodeController
 from trigger_node import TriggerNodeController
+from transport import Transport
+from dag import sort_dag, Edge, FanOut, JoinBuffer
+from stats import StatsSegment, StatsSegmentFull, HdrHistogram
+from profiler import install_profiler
 from utils import get_module_class, exception_catcher
 
 import logger
@@ -65,7 +67,7 @@ class StreamHeartBeat(object):
         raise StreamHeartBeatNotImplement
 
 
-def create_trigger_node(stream_name, name, conf):
+def create_trigger_node(stream_name, name, conf, transport=None):
     trigger_name = name
     module_path = conf.get('module', None)
     if not module_path:
@@ -76,15 +78,17 @@ def create_trigger_node(stream_name, name, conf):
         raise Exception("Load Trigger %s's module: %s Error: %s" % (trigger_name, module_path, str(e)))
     trigger_conf = conf.get('args', {})
     pool_size = conf.get('pool_size', 1)
+    flow_control = conf.get('flow_control', True)
 
     trigger_name = stream_name + "." + trigger_name
     trigger_controller = \
-        TriggerNodeController(trigger_name, trigger_cls, trigger_conf, pool_size=pool_size)
+        TriggerNodeController(trigger_name, trigger_cls, trigger_conf, pool_size=pool_size, transport=transport,
+                              flow_control=flow_control)
 
     return trigger_controller
 
 
-def create_processer_node(stream_name, name, conf):
+def create_processer_node(stream_name, name, conf, transport=None):
     node_name = name
     module_path = conf.get('module', None)
     if not module_path:
@@ -98,6 +102,21 @@ def create_processer_node(stream_name, name, conf):
     poll_timeout = conf.get('poll_timeout', 1)
     queue_size= conf.get('queue_size', 10000)
     mode = conf.get('mode', 'single')
+    batch_size = conf.get('batch_size', None)
+    batch_linger_ms = conf.get('batch_linger_ms', 0)
+    overflow = conf.get('overflow', 'drop_newest')
+    block_timeout = conf.get('block_timeout', 1)
+    spill_path = conf.get('spill_path', None)
+    concurrency = conf.get('concurrency', 100)
+    partition_by = conf.get('partition_by', None)
+    ordered = conf.get('ordered', False)
+    reorder_size = conf.get('reorder_size', 10000)
+    filter_in_worker = conf.get('filter_in_worker', False)
+    output_lane = conf.get('output_lane', False)
+    min_pool = conf.get('min_pool', None)
+    max_pool = conf.get('max_pool', None)
+    scale_interval = conf.get('scale_interval', 1)
+    stats_window = conf.get('stats_window', 10)
 
     _filter = conf.get('filter', None)
     _filter = [] if _filter is None else _filter
@@ -106,51 +125,165 @@ def create_processer_node(stream_name, name, conf):
 
     node_name = stream_name + "." + node_name
     node = ProcNodeController(node_name, node_cls, node_args,
-                              pool_size=pool_size, poll_timeout=poll_timeout, queue_size=queue_size, mode=mode, filter=_filter)
+                              pool_size=pool_size, poll_timeout=poll_timeout, queue_size=queue_size, mode=mode, filter=_filter,
+                              transport=transport, batch_size=batch_size, batch_linger_ms=batch_linger_ms,
+                              overflow=overflow, block_timeout=block_timeout, spill_path=spill_path,
+                              concurrency=concurrency, partition_by=partition_by, ordered=ordered,
+                              reorder_size=reorder_size, filter_in_worker=filter_in_worker,
+                              output_lane=output_lane, min_pool=min_pool, max_pool=max_pool,
+                              scale_interval=scale_interval, stats_window=stats_window)
     return node
 
 
-def init(stream_name, config):
+def create_transport(conf):
+    mode = conf.get('transport', 'json')
+    guard = conf.get('event_guard', 'none')
+    return Transport(mode, guard)
+
+
+def init_chain(stream_name, config, transport, fuse):
+    """ process 列表中的节点依次串联, 返回节点列表 """
     processers = []
-    triggers = []
     emit = None
+    credit = None
+    next_node = None
     for name, cfg in config['processer'].items()[::-1]:
-        proc_node = create_processer_node(stream_name, name, cfg)
-        proc_node.register_emit(emit)
+        proc_node = create_processer_node(stream_name, name, cfg, transport)
+        if fuse and next_node and proc_node.is_single() and next_node.is_single():
+            # 相邻的 single 节点融合为一条直接调用链
+            proc_node.register_emit(next_node.fused_input, fused=True)
+            logger.info("Processer fuse %s -> %s" % (proc_node.name, next_node.name))
+        else:
+            proc_node.register_emit(emit)
+        proc_node.register_credit(credit)
         emit = proc_node.input
+        credit = proc_node.credit
+        next_node = proc_node
         processers.append(proc_node)
         logger.info("Processer register %s emit func as %s" % (proc_node.name, emit))
     processers.reverse()
+    return processers
+
+
+def init_dag(stream_name, config, transport, fuse, dag, join_conf):
+    """
+    按 dag 配置连接节点, 一个节点的输出分发给它的所有后继节点, 有多个前驱的节点汇合所有分支的输出。
+    join 中配置的 merge 节点按 key 汇合各分支对同一个 Event 的结果后再处理。
+    返回按拓扑序排列的节点列表, 以及没有前驱的入口节点列表
+    """
+    names = config['processer'].keys()
+    order, preds = sort_dag(stream_name, names, dag)
+    nodes = OrderedDict()
+    for name in order:
+        nodes[name] = create_processer_node(stream_name, name, config['processer'][name], transport)
+
+    joins = {}
+    for name, cfg in join_conf.items():
+        if name not in nodes or len(preds[name]) < 2:
+            raise Exception("Stream %s join node %s must have more than one predecessor" % (stream_name, name))
+        if 'key' not in cfg:
+            raise Exception("Stream %s join node %s doesn't has key conf" % (stream_name, name))
+        joins[name] = JoinBuffer(nodes[name].name, preds[name], cfg['key'], nodes[name].fused_input, transport,
+                                 timeout=cfg.get('timeout', 5))
+        nodes[name].register_join(joins[name])
+
+    for name, node in nodes.items():
+        successors = dag.get(name, [])
+        if not successors:
+            continue
+        dst = nodes[successors[0]]
+        if fuse and len(successors) == 1 and len(preds[successors[0]]) == 1 and node.is_single() and dst.is_single():
+            # 只有一条边相连的两个 single 节点融合为直接调用链
+            fan_out = FanOut([Edge(dst, dst.fused_input)], transport)
+            node.register_emit(fan_out, fused=True)
+            logger.info("Processer fuse %s -> %s" % (node.name, dst.name))
+        else:
+            edges = []
+            for successor in successors:
+                target = joins[successor].input_from(name) if successor in joins else nodes[successor].input
+                edges.append(Edge(nodes[successor], target))
+            fan_out = FanOut(edges, transport)
+            node.register_emit(fan_out)
+            logger.info("Processer register %s emit to %s" % (node.name, successors))
+        node.register_credit(fan_out.credit)
+
+    entries = [nodes[name] for name in order if not preds[name]]
+    return nodes.values(), entries
 
-    logger.info("init stream process finish: %s " % [p.name for p in processers])
+
+def init(stream_name, config):
+    triggers = []
+    stream_conf = config.get('stream', {})
+    transport = create_transport(stream_conf)
+    fuse = stream_conf.get('fuse', True)
+    dag = stream_conf.get('dag', None)
+    logger.info("Stream %s transport mode: %s, event_guard: %s" % (stream_name, transport.mode, transport.guard))
 
     emit = None
-    if len(processers) > 0:
-        emit = processers[0].input
+    credit = None
+    if dag:
+        processers, entries = init_dag(stream_name, config, transport, fuse, dag, stream_conf.get('join', {}))
+        fan_out = FanOut([Edge(node, node.input) for node in entries], transport)
+        emit = fan_out
+        credit = fan_out.credit
+    else:
+        processers = init_chain(stream_name, config, transport, fuse)
+        if len(processers) > 0:
+            emit = processers[0].input
+            credit = processers[0].credit
+
+    logger.info("init stream process finish: %s " % [p.name for p in processers])
+
+    # 端到端延迟: Trigger 按采样率标记 Event 的进入时间, 没有下游的节点处理完成时记录
+    sample_rate = stream_conf.get('latency_sample_rate', 0)
+    end_to_end = HdrHistogram() if sample_rate > 0 else None
+    if end_to_end is not None:
+        for process in processers:
+            process.register_latency(end_to_end)
+
+    # 节点的 CPU 时间统计, 每个 Event 需要两次 clock_gettime, 默认关闭
+    if stream_conf.get('cpu_stats', False):
+        for process in processers:
+            process.register_cpu_stats()
 
     for name, cfg in config['trigger'].items():
-        trigger = create_trigger_node(stream_name, name, cfg)
+        trigger = create_trigger_node(stream_name, name, cfg, transport)
         trigger.register_emit(emit)
+        trigger.register_credit(credit)
+        if end_to_end is not None:
+            trigger.register_latency(sample_rate)
         logger.info("Trigger register %s emit func as %s" % (trigger.name, emit))
         triggers.append(trigger)
-    return triggers, processers
+    return triggers, processers, end_to_end
 
 
-def get_stream_runtime_info(triggers, processers):
+def get_stream_runtime_info(triggers, processers, end_to_end=None):
     info = OrderedDict()
     info['trigger'] = OrderedDict()
     info['process'] = OrderedDict()
     for trigger in triggers:
-        info['trigger'][trigger.name] = {'emit': trigger.runtime_info()}
+        info['trigger'][trigger.name] = trigger.runtime_info()
     for process in processers:
-        recv_count, emit_count, drop_count, mode, pending_count = process.runtime_info()
-        info['process'][process.name] = {'emit': emit_count, 'recv': recv_count,
-                                         'drop': drop_count, 'mode': mode, 'pending': pending_count}
+        info['process'][process.name] = process.runtime_info()
+    if end_to_end is not None:
+        info['end_to_end'] = end_to_end.dump()
     info['remote_logger_pending'] = logger.remote_logger_pending_count()
-    return json.dumps(info)
+    return info
+
+
+def get_stream_counters(triggers, processers, end_to_end=None):
+    """ runtime info 中由 Counter 原地更新的字段, {路径: Counter} """
+    counters = {}
+    for trigger in triggers:
+        for k, counter in trigger.counters().items():
+            counters[('trigger', trigger.name, k)] = counter
+    for process in processers:
+        for k, counter in process.counters().items():
+            counters[('process', process.name, k)] = counter
+    return counters
 
 
-def start_stream(triggers, processers):
+def start_stream(triggers, processers, end_to_end=None):
     # 从最后一个开始启动
     for process in processers[::-1]:
         process.start()
@@ -159,7 +292,7 @@ def start_stream(triggers, processers):
     logger.info(" ----- ")
 
 
-def stop_stream(triggers, processers):
+def stop_stream(triggers, processers, end_to_end=None):
     for trigger in triggers:
         trigger.stop()
         # 从第一个开始停止
@@ -167,19 +300,61 @@ def stop_stream(triggers, processers):
         process.stop()
 
 
+# 聚合副本的 runtime info 时取最大值而不是求和的字段, 延迟的分位数无法合并, 取各副本中最大的(偏保守)
+aggregate_max_keys = ('max_depth', 'hol_wait_max', 'lag', 'lag_max', 'busy', 'p50', 'p99', 'p999', 'max')
+
+
+def aggregate_runtime_info(infos, key=None):
+    """
+    合并多个副本的 runtime info: 数值求和(aggregate_max_keys 中的取最大值), list 按位置求和,
+    dict 递归合并, 其他类型(如 mode)取第一个副本的值
+    """
+    first = infos[0]
+    if isinstance(first, bool) or first is None:
+        return first
+    if isinstance(first, (int, long, float)):
+        values = [i for i in infos if isinstance(i, (int, long, float))]
+        if key in aggregate_max_keys:
+            return max(values)
+        return round(sum(values), 3) if isinstance(first, float) else sum(values)
+    if isinstance(first, dict):
+        merged = OrderedDict()
+        for info in infos:
+            for k in info:
+                if k not in merged:
+                    merged[k] = aggregate_runtime_info([i[k] for i in infos if k in i], k)
+        return merged
+    if isinstance(first, list):
+        return [aggregate_runtime_info(list(values), key) for values in zip(*infos)]
+    return first
+
+
 @exception_catcher(logger.error)
-def stream_main(name, config, start_event, stop_event, notify_queue):
+def stream_main(name, config, start_event, stop_event, stats, stream_name=None):
     logger.init(name)
-    stream_obj = init(name, config)
+    # 主线程沿用了父进程中线程的名字, 改为 Stream 进程名, 便于在日志与 profiler 的结果中区分
+    threading.current_thread().name = name
+    profiler = install_profiler(name, config.get('stream', {}).get('profile', {}))
+    # 副本的进程名为 <Stream>#N, 节点名仍使用 Stream 名, 以便按节点聚合各副本的 runtime info
+    stream_obj = init(stream_name if stream_name else name, config)
     logger.info("Start Stream %s, pid=%s" % (name, os.getpid()))
     start_stream(*stream_obj)
-    start_event.set()
+    # recv/emit/drop 与队列的 overflow_drop/throttled 等计数由 Counter 直接写入共享内存;
+    # 队列积压、直方图等其余字段需要重新生成整个 runtime info, 每隔 stats_interval 秒刷新一次
+    counters = get_stream_counters(*stream_obj)
+    stats_interval = config.get('stream', {}).get('stats_interval', 1)
     while True:
-        if stop_event.is_set():
+        if stats is not None:
+            try:
+                stats.publish(get_stream_runtime_info(*stream_obj), counters)
+            except StatsSegmentFull as e:
+                logger.error("Stream %s stop publishing runtime info: %s" % (name, str(e)))
+                stats = None
+        if not start_event.is_set():
+            start_event.set()
+        profiler.poll()
+        if stop_event.wait(stats_interval):
             break
-        runtime_info = get_stream_runtime_info(*stream_obj)
-        notify_queue.put({name: runtime_info})
-        time.sleep(1)
     logger.info("Stop Stream %s, pid=%s" % (name, os.getpid()))
     stop_stream(*stream_obj)
     logger.fini()
@@ -187,14 +362,31 @@ def stream_main(name, config, start_event, stop_event, notify_queue):
 
 class Stream:
 
-    def __init__(self, name, config, notify_queue):
+    def __init__(self, name, config, stream_name=None):
         self.name = name
         self.config = config
         self.start_event = multiprocessing.Event()
         self.stop_event = multiprocessing.Event()
-        args = (self.name, self.config, self.start_event, self.stop_event, notify_queue)
+        # fork 之前创建, Stream 进程写入, 父进程直接读取; 之后无法扩大, 按节点数分配
+        stream_conf = config.get('stream', {})
+        nodes = len(config.get('trigger', {})) + len(config.get('processer', {})) + 1
+        self.stats = StatsSegment(layout_size=stream_conf.get('stats_layout_size', max(16384 * nodes, 65536)),
+                                  slot_count=stream_conf.get('stats_slots', max(1024 * nodes, 8192)))
+        args = (self.name, self.config, self.start_event, self.stop_event, self.stats, stream_name)
         self.process = multiprocessing.Process(target=stream_main, name=name, args=args)
 
+    def runtime_info(self):
+        info = OrderedDict()
+        stats = self.stats.read()
+        if stats is not None:
+            info[self.name] = stats
+        return info
+
+    def profile(self):
+        """ 通知 Stream 进程开始采样调用栈 """
+        if self.process.is_alive():
+            os.kill(self.process.pid, signal.SIGUSR1)
+
     def kill(self, wait_time, loop_time=0.5):
         # self.process.terminate()
         os.kill(self.process.pid, signal.SIGKILL)
@@ -229,17 +421,59 @@ class Stream:
         return False
 
 
+class StreamReplicas:
+    """
+    同一个 Stream 的多个副本进程, 每个副本运行完整的 Trigger 与 Node,
+    作为竞争消费者共同消费同一个数据源(如 RabbitMQ 队列), 从而使用多个 CPU 核心
+    """
+
+    def __init__(self, name, config, replicas):
+        self.name = name
+        self.replicas = [Stream("%s#%s" % (name, i + 1), config, stream_name=name) for i in range(replicas)]
+
+    def runtime_info(self):
+        """ Stream 名下为所有副本聚合后的 runtime info, 各副本的 runtime info 以副本名单独上报 """
+        replicas = OrderedDict()
+        for replica in self.replicas:
+            replicas.update(replica.runtime_info())
+        info = OrderedDict()
+        if replicas:
+            info[self.name] = aggregate_runtime_info(replicas.values())
+            info[self.name]['replicas'] = len(self.replicas)
+        info.update(replicas)
+        return info
+
+    def profile(self):
+        for replica in self.replicas:
+            replica.profile()
+
+    def start(self):
+        for i, replica in enumerate(self.replicas):
+            if not replica.start():
+                logger.error("start stream replica %s failed, stop started replicas" % replica.name)
+                for started in self.replicas[:i]:
+                    started.stop()
+                return False
+        return True
+
+    def stop(self):
+        result = True
+        for replica in self.replicas:
+            if not replica.stop():
+                result = False
+        return result
+
+
 class StreamController(object):
 
     def __init__(self, conf, poll_time=1):
-        self.notify_queue = None
         self.loop_stop = threading.Event()
         self.conf = conf
         self.poll_time = poll_time
-        self.runtime_info = {}  # dict 线程安全
         self.streams = {}
         self.heartbeats = {}
         self.oper_lock = threading.Lock()
+        self._profile_requested = False
 
     def acquire_oper_lock(func):
         def wapper(*args):
@@ -258,6 +492,7 @@ class StreamController(object):
             raise Exception('start_stream Error, Stream %s does not exsit' % name)
 
         stream_cfg = {}
+        stream_cfg['stream'] = self.conf['Streams'][name]
         trigger_name_list = self.conf['Streams'][name]['trigger']
         processer_name_list = self.conf['Streams'][name]['process']
 
@@ -277,7 +512,11 @@ class StreamController(object):
 
         if name in self.streams:
             raise Exception('start_stream Error, Stream %s already exist' % name)
-        stream = Stream(name, stream_cfg, self.notify_queue)
+        replicas = self.conf['Streams'][name].get('replicas', 1)
+        if replicas > 1:
+            stream = StreamReplicas(name, stream_cfg, replicas)
+        else:
+            stream = Stream(name, stream_cfg)
 
         if not stream.start():
             logger.error("Start stream %s Failed!!!" % name)
@@ -303,6 +542,25 @@ class StreamController(object):
         else:
             logger.error("Restart Stream Error, Strean %s does not exist" % name)
 
+    def request_profile(self):
+        """ 在信号处理函数中调用, 只设置标记, 由主循环调用 profile """
+        self._profile_requested = True
+
+    def profile(self):
+        """ 所有 Stream 进程开始采样调用栈, 结果写入日志目录 """
+        for name, stream in self.streams.items():
+            logger.info("Profile stream %s" % name)
+            stream.profile()
+
+    @property
+    def runtime_info(self):
+        """ 从各 Stream 进程的共享内存中读取当前的 runtime info """
+        info = OrderedDict()
+        for name, stream in self.streams.items():
+            info.update(stream.runtime_info())
+        info['remote_logger_pending'] = logger.remote_logger_pending_count()
+        return info
+
     def init_heartbeat(self, name, cfg):
         logger.info("Init HeartBeat %s" % name)
         cls = get_module_class(cfg['module'])
@@ -318,9 +576,6 @@ class StreamController(object):
     def start(self):
         logger.info("--------------------------------")
 
-        # start之后会变成守护进程，必须在此处初始notify_Queue
-        self.notify_queue = multiprocessing.Queue()
-
         # 启动所有Stream
         for name in self.conf['Streams']:
             self.start_stream(name)
@@ -331,14 +586,12 @@ class StreamController(object):
             self.heartbeats[name].initialize()
             self.heartbeats[name].start()
 
+        # runtime info 由各 Stream 进程写入共享内存, 读取时不需要在此收集
         while not self.loop_stop.is_set():
-            try:
-                ret = self.notify_queue.get(timeout=self.poll_time)
-                for k, v in ret.items():
-                    self.runtime_info[k] = json.loads(v, object_pairs_hook=OrderedDict)
-                self.runtime_info['remote_logger_pending'] = logger.remote_logger_pending_count()
-            except Empty:
-                pass
+            if self._profile_requested:
+                self._profile_requested = False
+                self.profile()
+            self.loop_stop.wait(self.poll_time)
 
         for name, hb in self.heartbeats.items():
             hb.cancel()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+# standard library modules
+import copy
+import ujson
+
+
+class EventFrozenError(TypeError):
+    pass
+
+
+class FrozenDict(dict):
+    """
+    只读dict, 用于object传输模式下防止节点之间互相修改Event。
+    需要修改时请先 thaw() 得到一份可写的拷贝。
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise EventFrozenError("event is frozen, use stream.transport.thaw() to get a writable copy")
+
+    __setitem__ = _readonly
+    __delitem__ = _readonly
+    clear = _readonly
+    pop = _readonly
+    popitem = _readonly
+    setdefault = _readonly
+    update = _readonly
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+
+def freeze(obj):
+    if type(obj) is FrozenDict:
+        return obj
+    if isinstance(obj, dict):
+        return FrozenDict((k, freeze(v)) for k, v in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+def thaw(obj):
+    if isinstance(obj, dict):
+        return dict((k, thaw(v)) for k, v in obj.iteritems())
+    if isinstance(obj, tuple):
+        return [thaw(v) for v in obj]
+    return obj
+
+
+# Event 保护方式:
+#   none   不做保护, 下游节点与上游共享同一个对象
+#   copy   每次交接时深拷贝一份, 节点间的修改互不可见
+#   freeze 交接时冻结为只读对象, 已冻结的对象可以直接共享, 无需再拷贝
+event_guard_set = {
+    'none': lambda event: event,
+    'copy': copy.deepcopy,
+    'freeze': freeze,
+}
+
+
+class Transport(object):
+    """
+    node 间 Event 的流转方式
+        json:   (默认) 每一跳都序列化为json字符串, 下一个节点收到后再反序列化
+        object: 同一个Stream进程内直接传递对象, 只在跨越进程边界(Trigger 收到的原始数据、
+                process 模式的节点)时才做序列化
+    """
+
+    def __init__(self, mode='json', guard='none'):
+        if mode not in ('json', 'object'):
+            raise Exception("Transport mode %s doesn't exist!" % mode)
+        if guard not in event_guard_set:
+            raise Exception("Transport event_guard %s doesn't exist!" % guard)
+        self.mode = mode
+        self.guard = guard
+        self._guard = event_guard_set[guard]
+        self.is_object = mode == 'object'
+
+    def ingest(self, raw):
+        """ Trigger 产生的数据转换为 Stream 内部的格式 """
+        if self.is_object:
+            if isinstance(raw, basestring):
+                return self._guard(ujson.loads(raw))
+            return self._guard(raw)
+        if isinstance(raw, dict):
+            return ujson.dumps(raw)
+        return raw
+
+    def pack(self, event):
+        """ node 发送 Event 给下一个节点前调用 """
+        if self.is_object:
+            return self._guard(event)
+        return ujson.dumps(event)
+
+    def unpack(self, raw):
+        """ node 收到上一个节点的 Event 时调用 """
+        if self.is_object:
+            return raw
+        return ujson.loads(raw)
+
+    def protect(self, event):
+        """ 同进程内直接调用下一个节点时(融合调用链), 不做序列化, 只按 event_guard 保护 """
+        if self.is_object:
+            return self._guard(event)
+        return event
+
+    def fork(self, event):
+        """ 同一个 Event 需要同时交给多个消费者时, 为额外的消费者准备一份 """
+        if self.is_object and self.guard == 'copy':
+            return copy.deepcopy(event)
+        return event
@@ -1,8 +1,13 @@
 # -*- coding:utf-8 -*-
-import ujson as json
+import time
 import logger
 import threading
 
+from transport import Transport
+from stats import Counter
+from dag import FanOut
+from process_node import set_event_context
+
 
 class ReaderOutputAlreadyExist(Exception):
     pass
@@ -64,20 +69,19 @@ class Trigger(object):
 
 class TriggerThread:
 
-    def __init__(self, cls, args, controller_emit_callback, name=None):
+    def __init__(self, cls, args, controller_emit_callback, name=None, transport=None):
         self.name = name if name else self.name
+        self._transport = transport if transport else Transport()
         self._trigger = cls(name, args, self.trigger_emit_callback)
         self._start_success = threading.Event()
         self._controller_emit_callback = controller_emit_callback
-        self.thread = threading.Thread(target=self.thread_run)
+        self.thread = threading.Thread(target=self.thread_run, name=self.name)
 
     def trigger_emit_callback(self, raw):
-        if type(raw) == str:
-            pass
-        elif type(raw) == dict:
-            raw = json.dumps(raw)
-        else:
+        if type(raw) not in (str, dict):
             raise TriggerError("error emit data type %s" % type(raw))
+        # 进入Stream的边界, 按Stream的transport转换为节点间流转的格式
+        raw = self._transport.ingest(raw)
         self._controller_emit_callback(raw)
 
     def thread_run(self):
@@ -97,27 +101,82 @@ class TriggerThread:
 
 class TriggerNodeController:
 
-    def __init__(self, name, trigger_cls, trigger_conf, pool_size=1):
+    # 两次检查下游 credit 之间最多递交的 Event 数
+    credit_batch = 64
+
+    def __init__(self, name, trigger_cls, trigger_conf, pool_size=1, transport=None, flow_control=True,
+                 flow_control_interval=0.01):
         self.name = name
 
         self._pool = []
         for i in range(pool_size):
             name = self.name + "-unit" + str(i + 1)
-            t = TriggerThread(trigger_cls, trigger_conf, self.controller_emit_callback, name=name)
+            t = TriggerThread(trigger_cls, trigger_conf, self.controller_emit_callback, name=name,
+                              transport=transport)
             self._pool.append(t)
         self._emit = None
-        self._emit_lock = threading.Lock()
-        self._emit_count = 0
+        self._emit_count = Counter()
+
+        self._credit = None
+        self._credit_left = 0
+        self._flow_control = flow_control
+        self._flow_control_interval = flow_control_interval
+        self._throttled_time = Counter(0.0)
+        self._stopping = threading.Event()
+        self._sample_every = 0
 
     def register_emit(self, emit):
         self._emit = emit
 
+    def register_credit(self, credit):
+        self._credit = credit
+
+    def register_latency(self, sample_rate):
+        """ 每 1/sample_rate 个 Event 采样一个, 记录其进入 Stream 的时间, 用于统计端到端延迟 """
+        self._sample_every = max(int(round(1.0 / sample_rate)), 1) if sample_rate > 0 else 0
+
+    def credit_budget(self, credit):
+        # 一个 Event 在下游可能产生多个 Event, 只预支剩余 credit 的一半
+        if credit is None:
+            return self.credit_batch
+        return min(credit // 2, self.credit_batch)
+
+    def wait_for_credit(self):
+        # 下游已饱和时阻塞 trigger 线程, trigger 也就暂停了拉取数据
+        # 上次检查预支的 credit 还有剩余时不再检查, 避免每个 Event 都要逐个读取下游各节点队列的长度
+        # 多个 trigger 线程并发修改 _credit_left 时只会多检查或少检查一次
+        if self._credit_left > 0:
+            self._credit_left -= 1
+            return
+        credit = self._credit()
+        if credit is None or credit > 0:
+            self._credit_left = self.credit_budget(credit)
+            return
+        start = time.time()
+        while not self._stopping.is_set():
+            time.sleep(self._flow_control_interval)
+            credit = self._credit()
+            if credit is None or credit > 0:
+                break
+        self._credit_left = self.credit_budget(credit)
+        self._throttled_time.add(time.time() - start)
+
     def controller_emit_callback(self, raw):
-        # 多个trigger thread 只能有一个同时对外输出
-        if self._emit_lock.acquire():
-            self._emit_count += 1
+        ingest = time.time() if self._sample_every and self._emit_count.value % self._sample_every == 0 else None
+        if self._flow_control and self._credit:
+            self.wait_for_credit()
+        # 多个trigger thread 并发调用下游节点的 input, 不持有锁:
+        # 下游的输入队列本身是线程安全的, single 模式的节点由其自身的锁保护
+        self._emit_count.add()
+        if ingest is None:
+            self._emit(raw)
+            return
+        # 采样的 Event: 进入时间放在 ctx 中, 下游节点在 input 时从 ctx 取得, 并随 Event 逐跳传递
+        prev = set_event_context({'ingest': ingest})
+        try:
             self._emit(raw)
-        self._emit_lock.release()
+        finally:
+            set_event_context(prev)
 
     def start(self):
         if self._emit is None:
@@ -132,9 +191,17 @@ class TriggerNodeController:
 
     def stop(self):
         logger.info("Stop Trigger %s" % self.name)
+        self._stopping.set()
         for trigger in self._pool:
             trigger.stop()
             logger.info("  |- Stop Trigger Unit %s id:%s" % (trigger.name, id(trigger)))
 
+    def counters(self):
+        """ runtime info 中由 Counter 原地更新的字段 """
+        return {'emit': self._emit_count, 'throttled': self._throttled_time}
+
     def runtime_info(self):
-        return self._emit_count
+        info = {'emit': self._emit_count.value, 'throttled': round(self._throttled_time.value, 3)}
+        if isinstance(self._emit, FanOut):
+            info['edges'] = self._emit.runtime_info()
+        return info
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+# standard library modules
+import os
+import sys
+import tempfile
+import unittest
+
+# stream 中的模块之间使用隐式相对导入
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stream'))
+
+import logger
+from dag import JoinBuffer
+from transport import Transport
+
+
+class JoinBufferTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        logger.g_logger_path = tempfile.gettempdir()
+        logger.init('test_join_buffer')
+
+    @classmethod
+    def tearDownClass(cls):
+        logger.fini()
+
+    def setUp(self):
+        self.out = []
+        self.join = JoinBuffer('J', ['A', 'B'], 'id', self.out.append, Transport('object'))
+
+    def test_merge(self):
+        self.join.add('A', {'id': 1, 'a': 1})
+        self.join.add('B', {'id': 1, 'b': 2})
+        self.assertEqual(self.out, [{'id': 1, 'a': 1, 'b': 2}])
+        self.assertEqual(self.join.runtime_info()['merged'], 1)
+
+    def test_duplicated_source_flushes_pending(self):
+        self.join.add('A', {'id': 1, 'a': 1})
+        self.join.add('A', {'id': 1, 'a': 2})
+        # 第一个 Event 不会被覆盖, 而是先单独交出
+        self.assertEqual(self.out, [{'id': 1, 'a': 1}])
+        self.join.add('B', {'id': 1, 'b': 3})
+        self.assertEqual(self.out, [{'id': 1, 'a': 1}, {'id': 1, 'a': 2, 'b': 3}])
+        info = self.join.runtime_info()
+        self.assertEqual((info['pending'], info['merged'], info['duplicated']), (0, 1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()